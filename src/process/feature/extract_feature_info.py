@@ -1,60 +1,170 @@
 import os
+import shutil
+import tempfile
+import argparse
+import numpy as np
 import pandas as pd
-import sys
 
-def process_feature_file(feature_file):
-    temp_df = pd.read_csv(feature_file, sep="\t")
-    temp_df['File_name'] = temp_df['File_name'].apply(lambda x: os.path.basename(str(x)))
+FEATURE_COLUMNS = ['File_name', 'Scans', 'Precursor_intensity', 'Fraction_feature_ID', 'Fraction_feature_intensity',
+                   'Fraction_feature_score', 'Fraction_feature_apex_time']
+# output column and format of the feature columns joined by ":"
+FEATURE_FORMATS = [
+    ("feature_id", 'Fraction_feature_ID', None),
+    ("feature_intensity", 'Fraction_feature_intensity', "%.2f"),
+    ("precursor_intensity", 'Precursor_intensity', "%.2f"),
+    ("feature_score", 'Fraction_feature_score', "%.5f"),
+    ("feature_apex_time", 'Fraction_feature_apex_time', "%.2f")
+]
+
+
+def format_column(values, value_format):
+    # one %-format of the whole column, same text as f"{x:.2f}" for each value
+    if len(values) == 0:
+        return []
+    return (((value_format + "\n") * len(values)) % tuple(values)).split("\n")[:-1]
 
+
+def join_groups(strings, starts, ends):
+    return [":".join(strings[begin:end]) for begin, end in zip(starts, ends)]
+
+
+def aggregate_features(temp_df):
+    """
+    Join the features of each (File_name, Scans) group, sorted by
+    decreasing precursor intensity, into one row. The rows are sorted once
+    and the groups are consecutive runs of the sorted rows, so each column
+    is formatted once for all rows.
+    """
     temp_df = temp_df.sort_values(
         by=['File_name', 'Scans', 'Precursor_intensity'],
         ascending=[True, True, False]
     )
+    # groupby drops rows with a missing key
+    temp_df = temp_df[temp_df['Scans'].notna()]
 
-    def agg_func(group):
-        return pd.Series({
-            "feature_id": ":".join(group['Fraction_feature_ID'].astype(str)),
+    file_names = temp_df['File_name'].to_numpy()
+    scans = temp_df['Scans'].to_numpy()
+    is_start = np.ones(len(temp_df), dtype=bool)
+    is_start[1:] = (file_names[1:] != file_names[:-1]) | (scans[1:] != scans[:-1])
+    starts = np.flatnonzero(is_start)
+    ends = np.append(starts[1:], len(temp_df))
 
-            "feature_intensity": ":".join(
-                group['Fraction_feature_intensity'].map(lambda x: f"{x:.2f}")
-            ),
+    result = {
+        "File_name": pd.Series(file_names[starts], dtype=temp_df['File_name'].dtype),
+        "Scans": pd.Series(scans[starts], dtype=temp_df['Scans'].dtype)
+    }
+    for name, column, value_format in FEATURE_FORMATS:
+        if value_format is None:
+            strings = temp_df[column].astype(str).tolist()
+        else:
+            strings = format_column(temp_df[column].tolist(), value_format)
+        result[name] = join_groups(strings, starts.tolist(), ends.tolist())
+    return pd.DataFrame(result)
 
-            "precursor_intensity": ":".join(
-                group['Precursor_intensity'].map(lambda x: f"{x:.2f}")
-            ),
 
-            "feature_score": ":".join(
-                group['Fraction_feature_score'].map(lambda x: f"{x:.5f}")
-            ),
+def process_feature_file(feature_file):
+    temp_df = pd.read_csv(feature_file, sep="\t")
+    temp_df['File_name'] = temp_df['File_name'].apply(lambda x: os.path.basename(str(x)))
+    return aggregate_features(temp_df)
+
 
-            "feature_apex_time": ":".join(
-                group['Fraction_feature_apex_time'].map(lambda x: f"{x:.2f}")
-            )
-        })
+def partition_feature_file(feature_file, part_dir, chunk_size, scan_bucket):
+    """
+    Split the feature columns of a feature file into partition files by
+    file name and scan range (Scans // scan_bucket), reading chunk_size rows
+    at a time. Returns the partition files in output order and the columns
+    read as floats in any chunk, which are floats in the whole file.
+    """
+    partitions = {}
+    float_columns = set()
+    for chunk in pd.read_csv(feature_file, sep="\t", usecols=FEATURE_COLUMNS, chunksize=chunk_size):
+        for column in ['Scans', 'Fraction_feature_ID']:
+            if chunk[column].dtype.kind == "f":
+                float_columns.add(column)
+        chunk['File_name'] = chunk['File_name'].apply(lambda x: os.path.basename(str(x)))
+        chunk = chunk[chunk['Scans'].notna()]
+        buckets = chunk['Scans'] // scan_bucket
+        for (file_name, bucket), part_df in chunk.groupby([chunk['File_name'], buckets], sort=False):
+            key = (file_name, bucket)
+            if key not in partitions:
+                partitions[key] = os.path.join(part_dir, f"part_{len(partitions)}.tsv")
+                part_df.to_csv(partitions[key], sep="\t", index=False)
+            else:
+                part_df.to_csv(partitions[key], sep="\t", index=False, header=False, mode="a")
+    return [partitions[key] for key in sorted(partitions)], float_columns
 
-    result_df = (
-        temp_df
-        .groupby(['File_name', 'Scans'], as_index=False)
-        .apply(agg_func, include_groups=False)
-        .reset_index(drop=True)
-    )
 
-    return result_df
+def iter_feature_chunks(feature_file, chunk_size=1000000, scan_bucket=10000, tmp_dir=None):
+    """
+    Streaming version of process_feature_file for feature files larger than
+    memory: yield the rows of the output in order, one partition (file name
+    and scan range) at a time. Only one partition is loaded at a time. The
+    partition files are written in a directory created in tmp_dir (default:
+    the system temporary directory).
+    """
+    part_dir = tempfile.mkdtemp(prefix="feature_parts_", dir=tmp_dir)
+    try:
+        part_files, float_columns = partition_feature_file(feature_file, part_dir, chunk_size, scan_bucket)
+        # file names are read as text, e.g. "nan" or "1"
+        dtypes = {'File_name': str}
+        for column in float_columns:
+            dtypes[column] = np.float64
+        na_values = {column: [""] for column in FEATURE_COLUMNS if column != 'File_name'}
+        for part_file in part_files:
+            part_df = pd.read_csv(part_file, sep="\t", dtype=dtypes, keep_default_na=False, na_values=na_values)
+            yield aggregate_features(part_df)
+            os.remove(part_file)
+    finally:
+        shutil.rmtree(part_dir, ignore_errors=True)
 
 
-def write_feature_file(dataset_id, feature_file, output_filename):
-    df = process_feature_file(feature_file)
-    df["DATASET_id"] = dataset_id
-    # save the file
-    df.to_csv(output_filename, sep="\t", index=False)
+def write_feature_file(dataset_id, feature_file, output_filename, chunk_size=0, scan_bucket=10000, tmp_dir=None):
+    # chunk_size > 0: stream the feature file in chunks of chunk_size rows,
+    # the partitions are written in tmp_dir (default: the output directory)
+    if chunk_size > 0:
+        if tmp_dir is None:
+            tmp_dir = os.path.dirname(os.path.abspath(output_filename))
+        count = 0
+        for df in iter_feature_chunks(feature_file, chunk_size, scan_bucket, tmp_dir):
+            df["DATASET_id"] = dataset_id
+            df.to_csv(output_filename, sep="\t", index=False, header=(count == 0), mode="w" if count == 0 else "a")
+            count += 1
+        if count == 0:
+            write_feature_file(dataset_id, feature_file, output_filename)
+            return
+    else:
+        df = process_feature_file(feature_file)
+        df["DATASET_id"] = dataset_id
+        # save the file
+        df.to_csv(output_filename, sep="\t", index=False)
     print(f"Processed feature file saved to: {output_filename}")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Usage: python script.py <dataset_id> <feature_filename> <output_tsv_filename>")
-    else:
-        dataset_id = sys.argv[1]
-        feature_file = sys.argv[2]
-        out_filename = sys.argv[3]
-        write_feature_file(dataset_id, feature_file, out_filename)
+    parser = argparse.ArgumentParser(
+        description="Join the features of each MS2 scan of a TopFD feature file"
+    )
+    parser.add_argument("dataset_id", help="MS dataset ID")
+    parser.add_argument("feature_file", help="Input feature file (*_ms2.feature)")
+    parser.add_argument("output_tsv_filename", help="Output TSV file")
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=0,
+        help="Read the feature file in chunks of chunk_size rows for files larger than memory (default: 0, read the whole file)"
+    )
+    parser.add_argument(
+        "--scan_bucket",
+        type=int,
+        default=10000,
+        help="Number of scans of a partition loaded at once with --chunk_size (default: 10000)"
+    )
+    parser.add_argument(
+        "--tmp_dir",
+        default=None,
+        help="Directory of the temporary partition files with --chunk_size (default: the directory of the output file)"
+    )
+
+    args = parser.parse_args()
+    write_feature_file(args.dataset_id, args.feature_file, args.output_tsv_filename, args.chunk_size, args.scan_bucket,
+                       args.tmp_dir)
@@ -0,0 +1,128 @@
+import math
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+
+PROTON_MASS = 1.007276
+# mass shift between isotopic peaks, as in theo_patt.txt
+ISOTOPE_MASS_SHIFT = 1.00235
+
+# averagine amino acid composition and its monoisotopic mass
+AVERAGINE_COMPOSITION = {"C": 4.9384, "H": 7.7583, "N": 1.3577, "O": 1.4773, "S": 0.0417}
+AVERAGINE_MONO_MASS = 111.0543052
+ELEMENT_MONO_MASS = {"C": 12.0, "H": 1.0078250319, "N": 14.0030740052, "O": 15.9949146221, "S": 31.97207069}
+# isotope abundances by nominal mass shift
+ELEMENT_ISOTOPES = {
+    "C": [0.9893, 0.0107],
+    "H": [0.999885, 0.000115],
+    "N": [0.99636, 0.00364],
+    "O": [0.99757, 0.00038, 0.00205],
+    "S": [0.9493, 0.0076, 0.0429, 0.0, 0.0002]
+}
+
+AVERAGINE_BIN_WIDTH = 0.5
+AVERAGINE_CACHE_ENTRIES = 100000
+AVERAGINE_MIN_INTENSITY = 0.5
+AVERAGINE_SPEC_PREFIX = "averagine"
+
+
+def averagine_composition(mass):
+    """Return the atom counts of the averagine molecule of a monoisotopic mass."""
+    scale = mass / AVERAGINE_MONO_MASS
+    counts = {element: int(round(num * scale)) for element, num in AVERAGINE_COMPOSITION.items()}
+    # fill the mass difference with hydrogens
+    residual = mass - sum(ELEMENT_MONO_MASS[e] * n for e, n in counts.items())
+    counts["H"] = max(counts["H"] + int(round(residual / ELEMENT_MONO_MASS["H"])), 0)
+    return counts
+
+
+def isotope_power(dist, num, max_len):
+    # isotope distribution of num atoms by repeated squaring
+    result = np.array([1.0])
+    base = np.array(dist, dtype=np.float64)
+    while num > 0:
+        if num & 1:
+            result = np.convolve(result, base)[:max_len]
+        base = np.convolve(base, base)[:max_len]
+        num >>= 1
+    return result
+
+
+@lru_cache(maxsize=AVERAGINE_CACHE_ENTRIES)
+def averagine_distribution(mono_mass, min_intensity=AVERAGINE_MIN_INTENSITY):
+    """
+    Compute the isotope distribution of the averagine molecule of mono_mass.
+    Returns the peaks ((mass, intensity), ...) in the format of theo_patt.txt:
+    intensities are relative to the highest peak (100.0) and peaks below
+    min_intensity are removed. Results are memoized, the distribution of a
+    mass bin is shared by all charges.
+    """
+    max_len = 20 + int(mono_mass / 500)
+    dist = np.array([1.0])
+    for element, num in averagine_composition(mono_mass).items():
+        dist = np.convolve(dist, isotope_power(ELEMENT_ISOTOPES[element], num, max_len))[:max_len]
+    dist = dist / dist.max()
+    peaks = []
+    for k, p in enumerate(dist.tolist()):
+        intensity = round(p * 100, 4)
+        if intensity < min_intensity:
+            continue
+        peaks.append((mono_mass + k * ISOTOPE_MASS_SHIFT, intensity))
+    return tuple(peaks)
+
+
+class AveragineEnvelopeProvider():
+    """
+    Envelope provider computing averagine isotope distributions on demand,
+    used in place of the envelopes of theo_patt.txt. As with the table, a
+    mass uses the envelope of the next mass bin (bin_width apart). The m/z
+    values and intensity percents are cached by (mass bin, charge) and the
+    least recently used entries are evicted beyond max_entries.
+    """
+    def __init__(self, bin_width=AVERAGINE_BIN_WIDTH, max_entries=AVERAGINE_CACHE_ENTRIES,
+                 min_intensity=AVERAGINE_MIN_INTENSITY):
+        self.bin_width = bin_width
+        self.max_entries = max_entries
+        self.min_intensity = min_intensity
+        self.entries = OrderedDict()
+
+    def envelope(self, mono_mass):
+        """Return the envelope of a mass as a dict with 'mono_mass' and 'peaks'."""
+        env_mono_mass = math.ceil(mono_mass / self.bin_width) * self.bin_width
+        return {"mono_mass": env_mono_mass, "peaks": averagine_distribution(env_mono_mass, self.min_intensity)}
+
+    def get_entry(self, mono_mass, charge):
+        key = (math.ceil(mono_mass / self.bin_width), charge)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        env = self.envelope(mono_mass)
+        total_intensity = sum(intensity for mass, intensity in env["peaks"])
+        peaks = [((mass / charge) + PROTON_MASS, intensity, round(intensity / total_intensity, 3))
+                 for mass, intensity in env["peaks"]]
+        entry = (env["mono_mass"], peaks)
+        self.entries[key] = entry
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+
+    def get_annotated_mz_intensity(self, mono_mass, charge):
+        """Same output as mgf_anno.get_annotated_mz_intensity with averagine envelopes."""
+        env_mono_mass, peaks = self.get_entry(mono_mass, charge)
+        mz_err = (env_mono_mass - mono_mass) / charge
+        return [(round(mz - mz_err, 5), intensity, intensity_percent) for mz, intensity, intensity_percent in peaks]
+
+
+def is_averagine_spec(theo_file):
+    return theo_file.split(":")[0] == AVERAGINE_SPEC_PREFIX
+
+
+def averagine_spec(bin_width=AVERAGINE_BIN_WIDTH):
+    """Return the theo_file string selecting averagine envelopes, e.g. "averagine:0.5"."""
+    return f"{AVERAGINE_SPEC_PREFIX}:{bin_width}"
+
+
+def provider_from_spec(theo_file):
+    fields = theo_file.split(":")
+    bin_width = float(fields[1]) if len(fields) > 1 else AVERAGINE_BIN_WIDTH
+    return AveragineEnvelopeProvider(bin_width=bin_width)
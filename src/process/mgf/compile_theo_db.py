@@ -0,0 +1,13 @@
+import sys
+import time
+import mgf_anno
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python script.py <theo_patt.txt> <output_db_filename>")
+        sys.exit(1)
+    start_time = time.time()
+    num_envelopes, num_peaks = mgf_anno.compile_theo_db(sys.argv[1], sys.argv[2])
+    print(f"Compiled {num_envelopes} envelopes with {num_peaks} peaks in {time.time() - start_time:.2f} seconds.")
+    print(f"Saved to: {sys.argv[2]}")
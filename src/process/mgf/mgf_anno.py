@@ -1,6 +1,9 @@
+import os
 import json
 import bisect
 from collections import defaultdict
+import numpy as np
+import averagine
 from time import time
 # from xxlimited import new
 
@@ -40,9 +43,149 @@ def get_theo_envelopes_cached(theo_file):
     read all theoretical envelopes out in the file "theo_patt.txt" and store it as a dict
     """
     if theo_file not in _THEO_CACHE:
-        _THEO_CACHE[theo_file] = read_theo_patterns(theo_file)
+        if averagine.is_averagine_spec(theo_file):
+            # envelopes are computed on demand, see averagine.py
+            _THEO_CACHE[theo_file] = (averagine.provider_from_spec(theo_file), None)
+        elif is_theo_db(theo_file):
+            # envelopes are read from the memory-mapped arrays, not copied
+            env_arrays = get_theo_envelope_arrays_cached(theo_file)
+            _THEO_CACHE[theo_file] = (EnvelopeArrayView(env_arrays), env_arrays['mono_mass'])
+        else:
+            _THEO_CACHE[theo_file] = read_theo_patterns(theo_file)
     return _THEO_CACHE[theo_file]
 
+_THEO_ARRAY_CACHE = {}
+
+def build_envelope_arrays(envelopes, mono_mass_list):
+    """
+    Flatten the envelopes for the vectorized kernel. Peaks of envelope i are
+    peak_mass[offsets[i]:offsets[i+1]]. Intensity percents are computed
+    as in get_annotated_mz_intensity.
+    """
+    lengths = [len(env['peaks']) for env in envelopes]
+    peak_mass = []
+    peak_intensity = []
+    peak_percent = []
+    peak_is_max = []
+    for env in envelopes:
+        total_intensity = sum(intensity for mass, intensity in env['peaks'])
+        for mass, intensity in env['peaks']:
+            peak_mass.append(mass)
+            peak_intensity.append(intensity)
+            peak_percent.append(round(intensity / total_intensity, 3))
+            peak_is_max.append(intensity == 100)
+    return {
+        'mono_mass': np.array(mono_mass_list, dtype=np.float64),
+        'offsets': np.concatenate(([0], np.cumsum(lengths))).astype(np.int64),
+        'lengths': np.array(lengths, dtype=np.int64),
+        'peak_mass': np.array(peak_mass, dtype=np.float64),
+        'peak_intensity': np.array(peak_intensity, dtype=np.float64),
+        'peak_percent': np.array(peak_percent, dtype=np.float64),
+        'peak_is_max': np.array(peak_is_max, dtype=bool)
+    }
+
+
+class EnvelopeArrayView():
+    """
+    Envelopes of read_theo_patterns read from envelope arrays (e.g. the
+    memory-mapped arrays of load_theo_db): envelopes[i] is built from the
+    arrays when it is used, so workers do not copy the database.
+    """
+    def __init__(self, env_arrays):
+        self.env_arrays = env_arrays
+
+    def __len__(self):
+        return len(self.env_arrays['mono_mass'])
+
+    def __getitem__(self, i):
+        begin, end = self.env_arrays['offsets'][i:i + 2].tolist()
+        peaks = list(zip(self.env_arrays['peak_mass'][begin:end].tolist(),
+                         self.env_arrays['peak_intensity'][begin:end].tolist()))
+        return {'mono_mass': float(self.env_arrays['mono_mass'][i]), 'peaks': peaks}
+
+
+def get_theo_envelope_arrays_cached(theo_file):
+    if theo_file not in _THEO_ARRAY_CACHE:
+        if averagine.is_averagine_spec(theo_file):
+            raise ValueError("The vectorized kernel requires a theoretical envelope file, not averagine envelopes.")
+        if is_theo_db(theo_file):
+            _THEO_ARRAY_CACHE[theo_file] = load_theo_db(theo_file)
+        else:
+            envelopes, mono_mass_list = get_theo_envelopes_cached(theo_file)
+            _THEO_ARRAY_CACHE[theo_file] = build_envelope_arrays(envelopes, mono_mass_list)
+    return _THEO_ARRAY_CACHE[theo_file]
+
+
+# binary envelope database: magic, envelope and peak counts, then the arrays
+# of build_envelope_arrays in the order of THEO_DB_ARRAYS
+THEO_DB_MAGIC = b"THEODB01"
+THEO_DB_ARRAYS = [
+    ('mono_mass', np.float64, 'envelope'),
+    ('offsets', np.int64, 'offset'),
+    ('lengths', np.int64, 'envelope'),
+    ('peak_mass', np.float64, 'peak'),
+    ('peak_intensity', np.float64, 'peak'),
+    ('peak_percent', np.float64, 'peak'),
+    ('peak_is_max', np.bool_, 'peak')
+]
+
+
+def is_theo_db(theo_file):
+    with open(theo_file, 'rb') as f:
+        return f.read(len(THEO_DB_MAGIC)) == THEO_DB_MAGIC
+
+
+def compile_theo_db(theo_file, db_file):
+    """
+    Compile a theoretical envelope file "theo_patt.txt" into a binary database
+    file. The database can be used in place of the text file and is memory
+    mapped, so the pages are shared by all worker processes.
+    """
+    envelopes, mono_mass_list = read_theo_patterns(theo_file)
+    env_arrays = build_envelope_arrays(envelopes, mono_mass_list)
+    tmp_file = db_file + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(THEO_DB_MAGIC)
+        f.write(np.array([len(mono_mass_list), len(env_arrays['peak_mass'])], dtype='<i8').tobytes())
+        for name, dtype, _ in THEO_DB_ARRAYS:
+            f.write(np.ascontiguousarray(env_arrays[name], dtype=np.dtype(dtype).newbyteorder('<')).tobytes())
+    os.replace(tmp_file, db_file)
+    return len(mono_mass_list), len(env_arrays['peak_mass'])
+
+
+def load_theo_db(db_file):
+    """Memory map (read only) the arrays of a database created by compile_theo_db."""
+    header_size = len(THEO_DB_MAGIC) + 16
+    num_envelopes, num_peaks = np.fromfile(db_file, dtype='<i8', count=2, offset=len(THEO_DB_MAGIC)).tolist()
+    sizes = {'envelope': num_envelopes, 'offset': num_envelopes + 1, 'peak': num_peaks}
+    env_arrays = {}
+    offset = header_size
+    for name, dtype, size_key in THEO_DB_ARRAYS:
+        dtype = np.dtype(dtype).newbyteorder('<')
+        shape = (sizes[size_key],)
+        if shape[0] > 0:
+            env_arrays[name] = np.memmap(db_file, dtype=dtype, mode='r', offset=offset, shape=shape)
+        else:
+            env_arrays[name] = np.zeros(shape, dtype=dtype)
+        offset += shape[0] * dtype.itemsize
+    return env_arrays
+
+
+def round_array(values, ndigits):
+    """
+    Round an array with the same results as Python round(value, ndigits).
+    np.round may differ from round when the scaled value is close to a half,
+    these values are rounded with round.
+    """
+    scale = 10.0 ** ndigits
+    scaled = values * scale
+    rounded = np.rint(scaled) / scale
+    near_half = np.nonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6)[0]
+    for i in near_half:
+        rounded[i] = round(float(values[i]), ndigits)
+    return rounded
+
+
 # format conversion
 def safe_json_load(value):
     """convert JSON string to Python object if it's a string; otherwise return as is."""
@@ -56,7 +199,11 @@ def find_closest_env(envelopes, mono_mass_list, target_mono_mass):
     Finds the envelope whose monoisotopic mass is closest to target_mono_mass.
     Return the closest envolope index and corresponding 'mass' and 'peaks' in all envelopes
     """
-    idx = bisect.bisect_left(mono_mass_list, target_mono_mass) # return nearest index
+    if isinstance(mono_mass_list, np.ndarray):
+        # memory-mapped database, same index as bisect_left
+        idx = int(np.searchsorted(mono_mass_list, target_mono_mass, side='left'))
+    else:
+        idx = bisect.bisect_left(mono_mass_list, target_mono_mass) # return nearest index
     closest_env = envelopes[idx]
     return closest_env
 
@@ -65,6 +212,8 @@ def get_annotated_mz_intensity(mono_mass, charge, envelopes, mono_mass_list):
     """
     Given a monoisotopic monoisotopic mass and charge, return a list of (m/z, intensity) values for the envelope.
     """
+    if isinstance(envelopes, averagine.AveragineEnvelopeProvider):
+        return envelopes.get_annotated_mz_intensity(mono_mass, charge)
     env = find_closest_env(envelopes, mono_mass_list, mono_mass)
     mono_mass_err = env['mono_mass'] - mono_mass # get the mass difference between closest theoretical envelope and fragment mass.
     mz_err = mono_mass_err / charge
@@ -81,6 +230,135 @@ def get_annotated_mz_intensity(mono_mass, charge, envelopes, mono_mass_list):
     return annotated_peaks
 
 
+def annotate_centroid_peaks(envelopes, mono_mass_list, ms2_mass_list, ms2_inte_list, ms2_ch_list,
+                            ms2_mz_centroid_list, ms2_inte_centroid_list, ms2_deconv_label_list, ppm_tol):
+    """
+    Annotate the centroid peaks of one MS/MS spectrum given as Python lists. Returns a list with
+    one annotation tuple (or "" if unmatched) for each centroid peak.
+    """
+    PROTON_MASS = 1.007276 
+    all_theo_mz = []
+    all_theo_data = []  
+
+    for index, (mass, intensity, charge) in enumerate(zip(ms2_mass_list, ms2_inte_list, ms2_ch_list)):
+        annotated_peaks = get_annotated_mz_intensity(mass, charge, envelopes, mono_mass_list) # Given a (mass, charge), get annotated theoretical peaks.  
+        ann_idx_list = range(len(annotated_peaks))
+        ann_idx = 0
+        
+        for mz, inte, inte_per in annotated_peaks:
+            theo_mass = charge * (mz - PROTON_MASS) # convert m/z to mass 
+            if inte == 100:  # if theoretical isotopic intensity is "100", then set a flag to "yes" meaning the maximum intensity, otherwise, "no".  
+                flag = 'yes'
+            else:
+                flag = 'no'
+            
+            theo_intensity = intensity * inte_per  # compute theoretical peak intensity by experimental intensity × theoretical isotopic relative intensity  
+            
+            all_theo_mz.append(mz)
+            all_theo_data.append((mz, round(theo_mass, 5), index, charge, flag, ann_idx_list[ann_idx], theo_intensity, inte_per)) 
+            #  (theoretical m/z, theoretical mass, MS2 peak index, charge state, isotopic envelope ID, monoisotopic flag, isotopic peak index, 
+            #  theoretical intensity, isotopic relative intensity)
+            ann_idx += 1
+
+    # Sort by mz for bisect search (faster)
+    sorted_indices = sorted(range(len(all_theo_mz)), key=lambda x: all_theo_mz[x]) # sort all theoretical m/z values
+    sorted_mz = [all_theo_mz[i] for i in sorted_indices]
+    sorted_data = [all_theo_data[i] for i in sorted_indices]  
+        
+    # For each centroid m/z, find if any match exists
+    ms2_centroid_annot = []
+
+    # start to annotate for centroid peaks within error tolerance (ppm=20)
+    for exp_mz, exp_inte in zip(ms2_mz_centroid_list, ms2_inte_centroid_list):
+        matched = ""
+        tol_da = exp_mz * ppm_tol * 1e-6
+        
+        idx = bisect.bisect_left(sorted_mz, exp_mz - tol_da) # return nearest index
+        while idx < len(sorted_mz) and sorted_mz[idx] <= exp_mz + tol_da:
+            if abs(sorted_mz[idx] - exp_mz) <= tol_da: 
+                theo_mz, matched_mass, ms2_id, matched_charge, inte_flag, matched_idx, theo_intensity, inte_per = sorted_data[idx]
+                if ms2_deconv_label_list[ms2_id] != "": 
+                    # check if the deconvoluted fragment mass has a valid annotation (not '?'), then include it to centroid annotation
+                    matched = (exp_inte, matched_mass, ms2_id, matched_charge, theo_mz, inte_flag, matched_idx, theo_intensity, inte_per, ms2_deconv_label_list[ms2_id])
+                else:
+                    matched = (exp_inte, matched_mass, ms2_id, matched_charge, theo_mz, inte_flag, matched_idx, theo_intensity, inte_per, "")
+                break
+            idx += 1
+        ms2_centroid_annot.append(matched)
+    return ms2_centroid_annot
+
+
+def annotate_centroid_peaks_vectorized(env_arrays, ms2_mass_list, ms2_inte_list, ms2_ch_list,
+                                       ms2_mz_centroid_list, ms2_inte_centroid_list, ms2_deconv_label_list, ppm_tol):
+    """
+    Array version of annotate_centroid_peaks followed by filter_ms2_centroid_labels for one spectrum.
+    env_arrays is from build_envelope_arrays. The envelopes of all deconvoluted masses are expanded into
+    flat arrays, all centroid peaks are matched with searchsorted and the minimum intensity filter
+    is applied with grouped reductions. The results are identical to the two function path.
+    """
+    PROTON_MASS = 1.007276
+    n_centroid = len(ms2_mz_centroid_list)
+    ms2_centroid_annot = [""] * n_centroid
+    if len(ms2_mass_list) == 0 or n_centroid == 0:
+        return ms2_centroid_annot
+    masses = np.array(ms2_mass_list, dtype=np.float64)
+    intensities = np.array(ms2_inte_list, dtype=np.float64)
+    charges = np.array(ms2_ch_list, dtype=np.float64)
+
+    # expand the closest envelope of each deconvoluted mass
+    env_idx = np.searchsorted(env_arrays['mono_mass'], masses, side='left')
+    counts = env_arrays['lengths'][env_idx]
+    owner = np.repeat(np.arange(len(masses)), counts)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    peak_idx = np.arange(len(owner)) - np.repeat(starts, counts)
+    flat_idx = np.repeat(env_arrays['offsets'][env_idx], counts) + peak_idx
+    mz_err = (env_arrays['mono_mass'][env_idx] - masses) / charges
+    owner_charges = charges[owner]
+    theo_mz = env_arrays['peak_mass'][flat_idx] / owner_charges + PROTON_MASS
+    theo_mz = round_array(theo_mz - mz_err[owner], 5)
+    theo_mass = round_array(owner_charges * (theo_mz - PROTON_MASS), 5)
+    inte_per = env_arrays['peak_percent'][flat_idx]
+    theo_intensity = intensities[owner] * inte_per
+
+    order = np.argsort(theo_mz, kind='stable')
+    sorted_mz = theo_mz[order]
+
+    # the first theoretical peak within the tolerance of each centroid peak
+    exp_mz = np.array(ms2_mz_centroid_list, dtype=np.float64)
+    tol_da = exp_mz * ppm_tol * 1e-6
+    lo = np.searchsorted(sorted_mz, exp_mz - tol_da, side='left')
+    hi = np.searchsorted(sorted_mz, exp_mz + tol_da, side='right')
+    match = np.full(n_centroid, -1, dtype=np.int64)
+    has_candidate = np.nonzero(lo < hi)[0]
+    first = sorted_mz[lo[has_candidate]]
+    ok = np.abs(first - exp_mz[has_candidate]) <= tol_da[has_candidate]
+    match[has_candidate[ok]] = lo[has_candidate[ok]]
+    for i in has_candidate[~ok]:
+        for idx in range(lo[i] + 1, hi[i]):
+            if abs(sorted_mz[idx] - exp_mz[i]) <= tol_da[i]:
+                match[i] = idx
+                break
+
+    # keep matches with theoretical intensity >= the minimum experimental
+    # intensity matched to the same deconvoluted peak
+    matched = np.nonzero(match >= 0)[0]
+    if len(matched) == 0:
+        return ms2_centroid_annot
+    theo_idx = order[match[matched]]
+    matched_owner = owner[theo_idx]
+    exp_inte = np.array(ms2_inte_centroid_list, dtype=np.float64)[matched]
+    min_exp_inte = np.full(len(masses), np.inf)
+    np.minimum.at(min_exp_inte, matched_owner, exp_inte)
+    keep = theo_intensity[theo_idx] >= min_exp_inte[matched_owner]
+
+    for i, t, ms2_id in zip(matched[keep].tolist(), theo_idx[keep].tolist(), matched_owner[keep].tolist()):
+        inte_flag = 'yes' if env_arrays['peak_is_max'][flat_idx[t]] else 'no'
+        ms2_centroid_annot[i] = (ms2_inte_centroid_list[i], float(theo_mass[t]), ms2_id, ms2_ch_list[ms2_id],
+                                 float(theo_mz[t]), inte_flag, int(peak_idx[t]), float(theo_intensity[t]),
+                                 float(inte_per[t]), ms2_deconv_label_list[ms2_id])
+    return ms2_centroid_annot
+
+
 def get_ms2_centroid_label(theo_file, form_df, ppm_tol):
     """
     Annotate centroided MS/MS spectra using theoretical isotopic peaks.
@@ -129,56 +407,8 @@ def get_ms2_centroid_label(theo_file, form_df, ppm_tol):
         #time_1 += time() - time_1_start
 
         #time_2_start = time()
-        all_theo_mz = []
-        all_theo_data = []  
-    
-        for index, (mass, intensity, charge) in enumerate(zip(ms2_mass_list, ms2_inte_list, ms2_ch_list)):
-            annotated_peaks = get_annotated_mz_intensity(mass, charge, envelopes, mono_mass_list) # Given a (mass, charge), get annotated theoretical peaks.  
-            ann_idx_list = range(len(annotated_peaks))
-            ann_idx = 0
-            
-            for mz, inte, inte_per in annotated_peaks:
-                theo_mass = charge * (mz - PROTON_MASS) # convert m/z to mass 
-                if inte == 100:  # if theoretical isotopic intensity is "100", then set a flag to "yes" meaning the maximum intensity, otherwise, "no".  
-                    flag = 'yes'
-                else:
-                    flag = 'no'
-                
-                theo_intensity = intensity * inte_per  # compute theoretical peak intensity by experimental intensity × theoretical isotopic relative intensity  
-                
-                all_theo_mz.append(mz)
-                all_theo_data.append((mz, round(theo_mass, 5), index, charge, flag, ann_idx_list[ann_idx], theo_intensity, inte_per)) 
-                #  (theoretical m/z, theoretical mass, MS2 peak index, charge state, isotopic envelope ID, monoisotopic flag, isotopic peak index, 
-                #  theoretical intensity, isotopic relative intensity)
-                ann_idx += 1
-        #time_2 += time() - time_2_start
-        
-        #time_3_start = time()
-        # Sort by mz for bisect search (faster)
-        sorted_indices = sorted(range(len(all_theo_mz)), key=lambda x: all_theo_mz[x]) # sort all theoretical m/z values
-        sorted_mz = [all_theo_mz[i] for i in sorted_indices]
-        sorted_data = [all_theo_data[i] for i in sorted_indices]  
-            
-        # For each centroid m/z, find if any match exists
-        ms2_centroid_annot = []
-
-        # start to annotate for centroid peaks within error tolerance (ppm=20)
-        for exp_mz, exp_inte in zip(ms2_mz_centroid_list, ms2_inte_centroid_list):
-            matched = ""
-            tol_da = exp_mz * ppm_tol * 1e-6
-            
-            idx = bisect.bisect_left(sorted_mz, exp_mz - tol_da) # return nearest index
-            while idx < len(sorted_mz) and sorted_mz[idx] <= exp_mz + tol_da:
-                if abs(sorted_mz[idx] - exp_mz) <= tol_da: 
-                    theo_mz, matched_mass, ms2_id, matched_charge, inte_flag, matched_idx, theo_intensity, inte_per = sorted_data[idx]
-                    if ms2_deconv_label_list[ms2_id] != "": 
-                        # check if the deconvoluted fragment mass has a valid annotation (not '?'), then include it to centroid annotation
-                        matched = (exp_inte, matched_mass, ms2_id, matched_charge, theo_mz, inte_flag, matched_idx, theo_intensity, inte_per, ms2_deconv_label_list[ms2_id])
-                    else:
-                        matched = (exp_inte, matched_mass, ms2_id, matched_charge, theo_mz, inte_flag, matched_idx, theo_intensity, inte_per, "")
-                    break
-                idx += 1
-            ms2_centroid_annot.append(matched)
+        ms2_centroid_annot = annotate_centroid_peaks(envelopes, mono_mass_list, ms2_mass_list, ms2_inte_list, ms2_ch_list,
+                                                     ms2_mz_centroid_list, ms2_inte_centroid_list, ms2_deconv_label_list, ppm_tol)
     
         ms2_centroid_label_all.append(ms2_centroid_annot)
         #time_3 += time() - time_3_start
@@ -186,6 +416,26 @@ def get_ms2_centroid_label(theo_file, form_df, ppm_tol):
     return ms2_centroid_label_all
 
 
+def get_filtered_ms2_centroid_label_vectorized(theo_file, form_df, ppm_tol):
+    """
+    Same result as filter_ms2_centroid_labels(get_ms2_centroid_label(theo_file, form_df, ppm_tol))
+    using annotate_centroid_peaks_vectorized.
+    """
+    env_arrays = get_theo_envelope_arrays_cached(theo_file)
+    ms2_centroid_label_all = []
+    for ss in range(len(form_df)):
+        ms2_centroid_label_all.append(annotate_centroid_peaks_vectorized(
+            env_arrays,
+            safe_json_load(form_df['mass_all'].iloc[ss]),
+            safe_json_load(form_df['intensity_all'].iloc[ss]),
+            safe_json_load(form_df['charge_all'].iloc[ss]),
+            safe_json_load(form_df['mz_array'].iloc[ss]),
+            safe_json_load(form_df['intensity_array'].iloc[ss]),
+            safe_json_load(form_df['ms2_deconv_label'].iloc[ss]),
+            ppm_tol))
+    return ms2_centroid_label_all
+
+
 def filter_ms2_centroid_labels(ms2_centroid_label_all):
     """
     Filter matched centroid annotations based on theoretical intensity thresholds.
@@ -1,11 +1,15 @@
 import os
 import argparse
 import mgf_anno_util
+import averagine
 from multiprocessing import Pool, cpu_count
 import time
 
 
-def annotation_processing(theo_file, msalign_filename, mgf_filename, out_filename, num_workers=None):
+def annotation_processing(theo_file, msalign_filename, mgf_filename, out_filename, num_workers=None, batch_size=0, vectorized=False, columnar=False,
+                          stream=False, resume=False, checkpoint_interval=1000):
+    # The output is written to <out_filename>.part and renamed when complete.
+    # With resume, an interrupted run restarts from its last checkpoint.
     # start_time = time.time()    
     # Set workers
     num_workers = num_workers or max(cpu_count() - 1, 1)
@@ -13,40 +17,52 @@ def annotation_processing(theo_file, msalign_filename, mgf_filename, out_filenam
 
     # get ms2 data
     print(f"Annotation for file: {os.path.basename(mgf_filename)}")  
-    ms2_df = mgf_anno_util.load_msalign_data(msalign_filename)
-    #print(f"Loaded msalign data in {time.time() - time_start:.2f} seconds")
-    time_start = time.time()
-    mgf_df = mgf_anno_util.load_mgf_data(mgf_filename)
-    print(f"Loaded mgf data in {time.time() - time_start:.2f} seconds")
-    form_df = mgf_anno_util.combined_msalign_mgf(ms2_df, mgf_df)
+    form_df, columns = mgf_anno_util.load_annotation_input(msalign_filename, mgf_filename, columnar=columnar, stream=stream)
+    ckpt = mgf_anno_util.AnnotationCheckpoint(out_filename, resume=resume, interval=checkpoint_interval)
+    form_df = ckpt.skip_input(form_df)
+    if columnar or stream:
+        # the columnar container and the streaming join are only read by the shared memory protocol
+        batch_size = batch_size or 200
     #print(f"Combined msalign and mgf data in {time.time() - time_start:.2f} seconds")   
     # Multiprocessing
-    print(f"Processing {len(form_df)} spectra with {num_workers} workers...")
-
-    tasks = [
-        (row._asdict(), theo_file, ppm_tol)
-        for row in form_df.itertuples(index=False)
-    ]
+    if stream:
+        print(f"Processing spectra with {num_workers} workers (streaming join)...")
+    else:
+        print(f"Processing {len(form_df)} spectra with {num_workers} workers...")
 
     annotated_block_count = 0
+    input_count = ckpt.input_count
     start_time = time.time()    
-    with Pool(num_workers) as pool, open(out_filename, "w", encoding="utf-8", buffering=1024*1024*1024) as out:
-        for result in pool.imap(mgf_anno_util.process_one_spectrum, tasks, chunksize=50):
-            meta = result["meta"]
-            peaks = result["peaks"]
-            meta_lines = result["meta_lines"]
-            out.write("BEGIN IONS\n")
-            for k, v in meta.items():
-                out.write(f"{k}={v}\n")
-            for meta_line in meta_lines:
-                out.write(meta_line + "\n")
-            for line in peaks:
-                out.write(line + "\n")
-            out.write("END IONS\n\n")
-            
-            annotated_block_count += 1            
-            if annotated_block_count % 100 == 0:
+    if batch_size > 0:
+        # chunks of spectra are passed to workers in shared memory blocks,
+        # tagged with the key of their last spectrum for checkpoints
+        tagged_chunks = ((mgf_anno_util.chunk_key(task), shm, task)
+                         for shm, task in mgf_anno_util.iter_packed_chunks(form_df, batch_size, columns))
+        with mgf_anno_util.create_chunk_pool(num_workers) as pool, ckpt.open() as out:
+            for key, text, chunk_count in mgf_anno_util.iter_chunk_results(tagged_chunks, theo_file, ppm_tol, pool, num_workers,
+                                                                           vectorized=vectorized):
+                out.write(text)
+                annotated_block_count += chunk_count
+                input_count += chunk_count
+                ckpt.update(out, input_count, key)
                 print(f"\rAnnotated {annotated_block_count} spectra...", end='', flush=True)
+    else:
+        tasks = [
+            (row._asdict(), theo_file, ppm_tol, vectorized)
+            for row in form_df.itertuples(index=False)
+        ]
+
+        with Pool(num_workers) as pool, ckpt.open() as out:
+            for result in pool.imap(mgf_anno_util.process_one_spectrum, tasks, chunksize=50):
+                meta = result["meta"]
+                out.write(mgf_anno_util.format_mgf_block(meta, result["meta_lines"], result["peak_block"]))
+            
+                annotated_block_count += 1            
+                input_count += 1
+                ckpt.update(out, input_count, mgf_anno_util.spectrum_key(meta))
+                if annotated_block_count % 100 == 0:
+                    print(f"\rAnnotated {annotated_block_count} spectra...", end='', flush=True)
+    ckpt.finish()
                     
     end_time = time.time()
     elapsed = end_time - start_time
@@ -65,9 +81,20 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--theo_file", "-t",
-        required=True,
+        default=None,
         help="Path to the theoretical envelope file (theo_patt.txt)"
     )
+    parser.add_argument(
+        "--averagine",
+        action="store_true",
+        help="Compute averagine envelopes on demand instead of using --theo_file"
+    )
+    parser.add_argument(
+        "--bin_width",
+        type=float,
+        default=averagine.AVERAGINE_BIN_WIDTH,
+        help="Mass bin width of averagine envelopes in Da (default: 0.5)"
+    )
     parser.add_argument(
         "--mgf_file", "-m",
         required=True,
@@ -89,14 +116,60 @@ if __name__ == "__main__":
         default=None,
         help="Number of CPU workers (default: max CPUs - 1)"
     )
+    parser.add_argument(
+        "--batch_size", "-b",
+        type=int,
+        default=0,
+        help="Number of spectra sent to a worker in one shared memory block (default: 0, one spectrum per task)"
+    )
+    parser.add_argument(
+        "--vectorized",
+        action="store_true",
+        help="Annotate centroid peaks with the array kernel (same output)"
+    )
+    parser.add_argument(
+        "--columnar",
+        action="store_true",
+        help="Keep the peaks of all spectra in flat arrays instead of DataFrame columns (uses --batch_size, default 200)"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read the msalign and mgf files in step while annotating instead of loading them first (uses --batch_size, default 200)"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted run from the checkpoint of the output file"
+    )
+    parser.add_argument(
+        "--checkpoint_interval",
+        type=int,
+        default=1000,
+        help="Number of spectra between checkpoints (default: 1000)"
+    )
 
     args = parser.parse_args()
+    if args.stream and args.columnar:
+        parser.error("--stream cannot be used with --columnar")
+    if args.averagine:
+        if args.vectorized:
+            parser.error("--vectorized cannot be used with --averagine")
+        args.theo_file = averagine.averagine_spec(args.bin_width)
+    elif args.theo_file is None:
+        parser.error("one of --theo_file or --averagine is required")
 
     annotation_processing(
         args.theo_file,
         args.msalign_file,
         args.mgf_file,
         args.out,
-        args.num_workers
+        args.num_workers,
+        args.batch_size,
+        args.vectorized,
+        args.columnar,
+        args.stream,
+        args.resume,
+        args.checkpoint_interval
     )
 
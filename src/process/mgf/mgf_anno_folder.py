@@ -1,18 +1,75 @@
 import os
 import argparse
 import mgf_anno_util
-from multiprocessing import Pool, cpu_count
+import averagine
+from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
 import time
 
 
-def annotation_batch_processing(theo_file, msalign_dir, mgf_dir, out_dir, num_workers=None):
+def is_up_to_date(output_path, input_paths):
+    # the output is newer than all inputs
+    if not os.path.isfile(output_path):
+        return False
+    output_mtime = os.path.getmtime(output_path)
+    return all(output_mtime > os.path.getmtime(f) for f in input_paths)
+
+
+def print_summary(job, count, annotated_block_count):
+    elapsed = time.time() - job["start_time"]
+    mins = elapsed / 60
+    print("\n========== Annotation Summary ==========")
+    print(f"Processed file number   : {count}")
+    print(f"Output file             : {job['output_path']}")
+    print(f"Spectra written to file : {annotated_block_count}")
+    print(f"Time elapsed            : {elapsed:.2f} seconds ({mins:.2f} min)")
+    print("========================================\n")  
+
+
+def iter_folder_chunks(jobs, batch_size, columnar=False, stream=False):
+    """
+    Yield (job, shm, task) for the chunks of all jobs, in order, and
+    (job, None, None) after the last chunk of each job. The next pair of
+    files is loaded in a background thread while the chunks of the current
+    pair are annotated.
+    """
+    def load(job):
+        job["start_time"] = time.time()
+        print(f"Annotation for file: {os.path.basename(job['mgf_path'])}")  
+        return mgf_anno_util.load_annotation_input(job["msalign_path"], job["mgf_path"], columnar=columnar, stream=stream)
+
+    if not jobs:
+        return
+    with ThreadPoolExecutor(max_workers=1) as loader:
+        future = loader.submit(load, jobs[0])
+        for k, job in enumerate(jobs):
+            form_df, columns = future.result()
+            if k + 1 < len(jobs):
+                future = loader.submit(load, jobs[k + 1])
+            for shm, task in mgf_anno_util.iter_packed_chunks(form_df, batch_size, columns):
+                yield job, shm, task
+            yield job, None, None
+
+
+def annotation_batch_processing(theo_file, msalign_dir, mgf_dir, out_dir, num_workers=None, batch_size=200, vectorized=False, columnar=False,
+                                stream=False, overwrite=False):
     """
     Parameters:
-        theo_file [str]: theoretical envelop file "theo_patt.txt".
+        theo_file [str]: theoretical envelop file "theo_patt.txt", or averagine.averagine_spec() for averagine envelopes.
         msalign_dir [str]: annotated msalign file folder.
         mgf_dir [str]: mgf folder stores mgf files to be annotated.
         out_dir[str]: output directory
         num_workers [int]: number of cpu threads will be used, default = max(cpu)-1 
+        batch_size [int]: number of spectra in one shared memory task, default = 200 (0: one spectrum per task)
+        vectorized [bool]: use the array kernel to annotate centroid peaks
+        columnar [bool]: load the peaks in flat arrays (SpectrumColumns)
+        stream [bool]: join the msalign and mgf files while reading them (iter_joined_rows)
+        overwrite [bool]: annotate files whose output is newer than both inputs again
+
+    One pool of workers is used for all files. With batch_size > 0, the
+    chunks of consecutive files are annotated without waiting for the end of
+    the previous file, and the next pair of files is loaded while the current
+    one is annotated. Each output file is written in the order of its input.
     """
     # start_time = time.time()    
     # Set workers
@@ -33,63 +90,70 @@ def annotation_batch_processing(theo_file, msalign_dir, mgf_dir, out_dir, num_wo
     # Match files
     common_keys = set(mgf_file_dict.keys()) & set(msalign_file_dict.keys())    
     ppm_tol = 20
-    for key in common_keys:
+    jobs = []
+    for key in sorted(common_keys):
         mgf_path = os.path.join(mgf_dir, mgf_file_dict[key])
         msalign_path = os.path.join(msalign_dir, msalign_file_dict[key])
         output_file = mgf_file_dict[key] + "_annot.mgf"
         output_path = os.path.join(out_dir, output_file)
         filenames = [msalign_path, mgf_path]
-        if all(os.path.isfile(f) for f in filenames):
-            # get ms2 data
-            print(f"Annotation for file: {os.path.basename(mgf_path)}")  
-            ms2_df = mgf_anno_util.load_msalign_data(msalign_path)
-            #print(f"Loaded msalign data in {time.time() - time_start:.2f} seconds")
-            time_start = time.time()
-            mgf_df = mgf_anno_util.load_mgf_data(mgf_path)
-            print(f"Loaded mgf data in {time.time() - time_start:.2f} seconds")
-            form_df = mgf_anno_util.combined_msalign_mgf(ms2_df, mgf_df)
-            #print(f"Combined msalign and mgf data in {time.time() - time_start:.2f} seconds")   
-            # Multiprocessing
-            print(f"Processing {len(form_df)} spectra with {num_workers} workers...")
-
-            tasks = [
-                (row._asdict(), theo_file, ppm_tol)
-                for row in form_df.itertuples(index=False)
-            ]
-
-            annotated_block_count = 0
-            start_time = time.time()    
-            with Pool(num_workers) as pool, open(output_path, "w", encoding="utf-8", buffering=1024*1024*1024) as out:
-                for result in pool.imap(mgf_anno_util.process_one_spectrum, tasks, chunksize=50):
-                    meta = result["meta"]
-                    peaks = result["peaks"]
-                    meta_lines = result["meta_lines"]
-                    out.write("BEGIN IONS\n")
-                    for k, v in meta.items():
-                        out.write(f"{k}={v}\n")
-                    for meta_line in meta_lines:
-                        out.write(meta_line + "\n")
-                    for line in peaks:
-                        out.write(line + "\n")
-                    out.write("END IONS\n\n")
-            
-                    annotated_block_count += 1            
-                    if annotated_block_count % 100 == 0:
-                        print(f"\rAnnotated {annotated_block_count} spectra...", end='', flush=True)
-                    
-            end_time = time.time()
-            elapsed = end_time - start_time
-            mins = elapsed / 60
-            count += 1
-                    
-            print("\n========== Annotation Summary ==========")
-            print(f"Processed file number   : {count}")
-            print(f"Spectra written to file : {annotated_block_count}")
-            print(f"Time elapsed            : {elapsed:.2f} seconds ({mins:.2f} min)")
-            print("========================================\n")  
-            
-        else:
+        if not all(os.path.isfile(f) for f in filenames):
             print(f"One of mgf or msalign files missing for {key}")
+        elif not overwrite and is_up_to_date(output_path, filenames):
+            print(f"Skipping {key}: {output_path} is newer than the input files")
+        else:
+            jobs.append({"mgf_path": mgf_path, "msalign_path": msalign_path, "output_path": output_path})
+    if columnar or stream:
+        # the columnar container and the streaming join are only read by the shared memory protocol
+        batch_size = batch_size or 200
+    print(f"Processing {len(jobs)} files with {num_workers} workers...")
+
+    # outputs are written to a temporary file and renamed when complete
+    with mgf_anno_util.create_chunk_pool(num_workers) as pool:
+        if batch_size > 0:
+            # chunks of spectra are passed to workers in shared memory blocks
+            outputs = {}
+            for job, text, chunk_count in mgf_anno_util.iter_chunk_results(
+                    iter_folder_chunks(jobs, batch_size, columnar=columnar, stream=stream),
+                    theo_file, ppm_tol, pool, num_workers, vectorized=vectorized):
+                output_path = job["output_path"]
+                if output_path not in outputs:
+                    outputs[output_path] = [open(output_path + ".tmp", "w", encoding="utf-8", buffering=1024*1024*64), 0]
+                out_state = outputs[output_path]
+                if text is None:
+                    # all chunks of the file are written
+                    out_state[0].close()
+                    os.replace(output_path + ".tmp", output_path)
+                    del outputs[output_path]
+                    count += 1
+                    print_summary(job, count, out_state[1])
+                    continue
+                out_state[0].write(text)
+                out_state[1] += chunk_count
+                print(f"\rAnnotated {out_state[1]} spectra of {os.path.basename(output_path)}...", end='', flush=True)
+        else:
+            for job in jobs:
+                job["start_time"] = time.time()
+                print(f"Annotation for file: {os.path.basename(job['mgf_path'])}")  
+                form_df, _ = mgf_anno_util.load_annotation_input(job["msalign_path"], job["mgf_path"])
+                print(f"Processing {len(form_df)} spectra with {num_workers} workers...")
+                tasks = [
+                    (row._asdict(), theo_file, ppm_tol, vectorized)
+                    for row in form_df.itertuples(index=False)
+                ]
+
+                annotated_block_count = 0
+                with open(job["output_path"] + ".tmp", "w", encoding="utf-8", buffering=1024*1024*64) as out:
+                    for result in pool.imap(mgf_anno_util.process_one_spectrum, tasks, chunksize=50):
+                        meta = result["meta"]
+                        out.write(mgf_anno_util.format_mgf_block(meta, result["meta_lines"], result["peak_block"]))
+            
+                        annotated_block_count += 1            
+                        if annotated_block_count % 100 == 0:
+                            print(f"\rAnnotated {annotated_block_count} spectra...", end='', flush=True)
+                os.replace(job["output_path"] + ".tmp", job["output_path"])
+                count += 1
+                print_summary(job, count, annotated_block_count)
                                   
 
 if __name__ == "__main__":
@@ -98,9 +162,20 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--theo_file", "-t",
-        required=True,
+        default=None,
         help="Path to the theoretical envelope file (theo_patt.txt)"
     )
+    parser.add_argument(
+        "--averagine",
+        action="store_true",
+        help="Compute averagine envelopes on demand instead of using --theo_file"
+    )
+    parser.add_argument(
+        "--bin_width",
+        type=float,
+        default=averagine.AVERAGINE_BIN_WIDTH,
+        help="Mass bin width of averagine envelopes in Da (default: 0.5)"
+    )
     parser.add_argument(
         "--mgf_dir", "-m",
         required=True,
@@ -122,13 +197,52 @@ if __name__ == "__main__":
         default=None,
         help="Number of CPU workers (default: max CPUs - 1)"
     )
+    parser.add_argument(
+        "--batch_size", "-b",
+        type=int,
+        default=200,
+        help="Number of spectra sent to a worker in one shared memory block (default: 200, 0: one spectrum per task)"
+    )
+    parser.add_argument(
+        "--vectorized",
+        action="store_true",
+        help="Annotate centroid peaks with the array kernel (same output)"
+    )
+    parser.add_argument(
+        "--columnar",
+        action="store_true",
+        help="Keep the peaks of all spectra in flat arrays instead of DataFrame columns (uses --batch_size, default 200)"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read the msalign and mgf files in step while annotating instead of loading them first (uses --batch_size, default 200)"
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Annotate files whose output is newer than the input files again (default: skip them)"
+    )
 
     args = parser.parse_args()
+    if args.stream and args.columnar:
+        parser.error("--stream cannot be used with --columnar")
+    if args.averagine:
+        if args.vectorized:
+            parser.error("--vectorized cannot be used with --averagine")
+        args.theo_file = averagine.averagine_spec(args.bin_width)
+    elif args.theo_file is None:
+        parser.error("one of --theo_file or --averagine is required")
     annotation_batch_processing(
         args.theo_file,
         args.msalign_dir,
         args.mgf_dir,
         args.out_dir,
-        args.num_workers
+        args.num_workers,
+        args.batch_size,
+        args.vectorized,
+        args.columnar,
+        args.stream,
+        args.overwrite
     )
 
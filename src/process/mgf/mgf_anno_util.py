@@ -1,13 +1,44 @@
 import json
+import time
+import contextlib
+from array import array
+from collections import deque, OrderedDict
+from multiprocessing import Pool, shared_memory, resource_tracker
+import numpy as np
 import pandas as pd
 import mgf_anno 
+import spectrum_index
+from process.msalign import peak_format
+from process.msalign import checkpoint
 
 
-def load_mgf_data(mgf_file):
+def read_indexed_lines(spectrum_file, scans, file_format):
     """
-    Read a mgf file and return a Python DataFrame containing all information in a mgf file
+    Read the lines of the spectra with the given scans using the spectrum index
+    of the file instead of scanning the whole file
     """
-    rows = []
+    with spectrum_index.SpectrumIndex(spectrum_file, file_format=file_format) as index:
+        blocks = index.get_many(scans)
+    for block in blocks.values():
+        for line in block.splitlines():
+            yield line
+
+
+def iter_mgf_rows(mgf_file, scans=None, buffering=1024*1024*1024):
+    """
+    Read a mgf file and yield one dict for each spectrum, in file order.
+    If scans is given, only these scans are read using the spectrum index of the file.
+    """
+    if scans is not None:
+        fh = contextlib.closing(read_indexed_lines(mgf_file, scans, "mgf"))
+    else:
+        fh = open(mgf_file, "r", encoding="utf-8", errors="ignore", buffering=buffering)
+    with fh as lines:
+        yield from parse_mgf_lines(lines)
+
+
+def parse_mgf_lines(lines):
+    """Yield one dict for each spectrum in the lines of a mgf file."""
     dataset_id = None
     mzml_filename = None
     scan = None
@@ -19,87 +50,79 @@ def load_mgf_data(mgf_file):
     mz_all = []
     intensity_all = []
    
-    with open(mgf_file, "r", encoding="utf-8", errors="ignore", buffering=1024*1024*1024) as fh:
-        for line in fh:
-            line = line.strip()
+    for line in lines:
+        line = line.strip()
 
-            if len(line)> 0 and line[0] <= "9" and line[0] >= "0":
-                # Peak line
-                parts = line.split()
-                if len(parts) == 2:
-                    # mandatory fields
-                    mz_all.append(float(parts[0]))
-                    intensity_all.append(float(parts[1]))
+        if len(line)> 0 and line[0] <= "9" and line[0] >= "0":
+            # Peak line
+            parts = line.split()
+            if len(parts) == 2:
+                # mandatory fields
+                mz_all.append(float(parts[0]))
+                intensity_all.append(float(parts[1]))
 
-            elif line == "BEGIN IONS":
-                # reset for new spectrum
-                dataset_id = None
-                mzml_filename = None
-                scan = None
-                title = None
-                rtinseconds = None
-                pepmass_mz = None
-                charge = None
+        elif line == "BEGIN IONS":
+            # reset for new spectrum
+            dataset_id = None
+            mzml_filename = None
+            scan = None
+            title = None
+            rtinseconds = None
+            pepmass_mz = None
+            charge = None
+
+            mz_all = []
+            intensity_all = []
+        elif line.find("=") != -1:
+            if line.startswith("DATASET_ID="):
+                dataset_id = line.split("=", 1)[1]
+            elif line.startswith("MZML_FILE_NAME="):
+                mzml_filename = line.split("=", 1)[1]
 
-                mz_all = []
-                intensity_all = []
-            elif line.find("=") != -1:
-                if line.startswith("DATASET_ID="):
-                    dataset_id = line.split("=", 1)[1]
-                elif line.startswith("MZML_FILE_NAME="):
-                    mzml_filename = line.split("=", 1)[1]
-
-                elif line.startswith("SCAN="):
-                    scan = int(line.split("=", 1)[1])
-                
-                elif line.startswith("TITLE="):
-                    title = line.split("=", 1)[1]
-                
-                elif line.startswith("RTINSECONDS="):
-                    rtinseconds = float(line.split("=", 1)[1])
-                
-                elif line.startswith("PEPMASS_MZ="):
-                    pepmass_mz = float(line.split("=", 1)[1])
+            elif line.startswith("SCAN="):
+                scan = int(line.split("=", 1)[1])
             
-                elif line.startswith("CHARGE="):
-                    charge = line.split("=", 1)[1]
-
-            elif line == "END IONS":
-                if scan is not None:
-                    rows.append({
-                        "dataset_id": dataset_id,
-                        "mzml_file_name": mzml_filename,
-                        "scan": scan,
-                        "title": title,
-                        "rtinseconds": rtinseconds,
-                        "pepmass_mz": pepmass_mz,
-                        "charge": charge,
-                        "mz_array": mz_all,
-                        "intensity_array": intensity_all
-                    })
-
-                # clean up explicitly
-                dataset_id = None
-                mzml_filename = None
-                scan = None
-                title = None
-                rtinseconds = None
-                pepmass_mz = None
-                charge = None
-                
-    print(f"Loaded {len(rows)} spectra from {mgf_file}")
+            elif line.startswith("TITLE="):
+                title = line.split("=", 1)[1]
             
-    mgf_df = pd.DataFrame(rows)
-    return mgf_df
-
-
-
-def load_msalign_data(msalign_file):
+            elif line.startswith("RTINSECONDS="):
+                rtinseconds = float(line.split("=", 1)[1])
+            
+            elif line.startswith("PEPMASS_MZ="):
+                pepmass_mz = float(line.split("=", 1)[1])
+        
+            elif line.startswith("CHARGE="):
+                charge = line.split("=", 1)[1]
+
+        elif line == "END IONS":
+            if scan is not None:
+                yield {
+                    "dataset_id": dataset_id,
+                    "mzml_file_name": mzml_filename,
+                    "scan": scan,
+                    "title": title,
+                    "rtinseconds": rtinseconds,
+                    "pepmass_mz": pepmass_mz,
+                    "charge": charge,
+                    "mz_array": mz_all,
+                    "intensity_array": intensity_all
+                }
+
+            # clean up explicitly
+            dataset_id = None
+            mzml_filename = None
+            scan = None
+            title = None
+            rtinseconds = None
+            pepmass_mz = None
+            charge = None
+
+
+def iter_msalign_rows(msalign_file, scans=None):
     """
-    Read a msalign file and return a Python DataFrame containing all information in a msalign file
+    Read a msalign file and yield one dict for each spectrum, in file order.
+    If scans is given, only these scans are read using the spectrum index of the file.
     """
-    
-    rows = []
     dataset_id = None
     mzml_filename = None
     scan = None
@@ -110,8 +133,12 @@ def load_msalign_data(msalign_file):
     confidence_all = []
     ms2_deconv_label = []
 
-    with open(msalign_file, "r", encoding="utf-8", errors="ignore") as fh:
-        for line in fh:
+    if scans is not None:
+        fh = contextlib.closing(read_indexed_lines(msalign_file, scans, "msalign"))
+    else:
+        fh = open(msalign_file, "r", encoding="utf-8", errors="ignore")
+    with fh as lines:
+        for line in lines:
             line = line.strip()
 
             if line == "BEGIN IONS":
@@ -140,7 +167,7 @@ def load_msalign_data(msalign_file):
             elif line == "END IONS":
                 if scan is not None:
                     #print("label for scan {}: {}".format(scan, ms2_deconv_label))
-                    rows.append({
+                    yield {
                         "dataset_id": dataset_id,
                         "mzml_file_name": mzml_filename,
                         "scan": scan,
@@ -150,7 +177,7 @@ def load_msalign_data(msalign_file):
                         "charge_all": charge_all,
                         "confidence_all": confidence_all,
                         "ms2_deconv_label": ms2_deconv_label
-                    })
+                    }
 
                 # clean up explicitly
                 dataset_id = None
@@ -170,12 +197,122 @@ def load_msalign_data(msalign_file):
                     ms2_deconv_label.append(" ".join(parts[4:]))
                 else:
                     ms2_deconv_label.append("")
-                   
-    msalign_df = pd.DataFrame(rows)
+
+
+def load_mgf_data(mgf_file, scans=None, columnar=False):
+    """
+    Read a mgf file and return a Python DataFrame containing all information in a mgf file.
+    If scans is given, only these scans are read using the spectrum index of the file.
+    If columnar is True, a SpectrumColumns object is returned instead.
+    """
+    if columnar:
+        rows, peaks, offsets = collect_columns(iter_mgf_rows(mgf_file, scans), {
+            "mz_array": ("mz", "d"),
+            "intensity_array": ("intensity", "d")
+        })
+        print(f"Loaded {len(rows)} spectra from {mgf_file}")
+        return SpectrumColumns(pd.DataFrame(rows), peaks, offsets)
+    rows = list(iter_mgf_rows(mgf_file, scans))
+    print(f"Loaded {len(rows)} spectra from {mgf_file}")
+            
+    mgf_df = pd.DataFrame(rows)
+    return mgf_df
+
+
+def load_msalign_data(msalign_file, scans=None, columnar=False):
+    """
+    Read a msalign file and return a Python DataFrame containing all information in a msalign file.
+    If scans is given, only these scans are read using the spectrum index of the file.
+    If columnar is True, a SpectrumColumns object is returned instead.
+    """
+    if columnar:
+        rows, peaks, offsets = collect_columns(iter_msalign_rows(msalign_file, scans), {
+            "mass_all": ("mass", "d"),
+            "intensity_all": ("intensity", "d"),
+            "charge_all": ("charge", "q"),
+            "confidence_all": ("confidence", "d"),
+            "ms2_deconv_label": ("label", None)
+        })
+        return SpectrumColumns(pd.DataFrame(rows), peaks, offsets)
+    msalign_df = pd.DataFrame(list(iter_msalign_rows(msalign_file, scans)))
     
     return msalign_df
 
 
+def collect_columns(rows, peak_columns):
+    """
+    Move the peak lists of rows into flat arrays. peak_columns maps a row key
+    to (array name, array typecode); typecode None keeps Python objects.
+    Returns the rows without peak lists, the arrays and the offsets.
+    """
+    values = {key: (array(typecode) if typecode else []) for key, (_, typecode) in peak_columns.items()}
+    meta_rows = []
+    offsets = [0]
+    for row in rows:
+        for key in peak_columns:
+            values[key].extend(row.pop(key))
+        meta_rows.append(row)
+        offsets.append(len(values[next(iter(peak_columns))]))
+    peaks = {}
+    for key, (name, typecode) in peak_columns.items():
+        if typecode is None:
+            peaks[name] = np.array(values[key], dtype=object)
+        else:
+            peaks[name] = np.frombuffer(values[key], dtype=np.float64 if typecode == "d" else np.int64)
+    return meta_rows, peaks, offsets
+
+
+class SpectrumColumns():
+    """
+    Columnar container of the spectra of a msalign or mgf file. The peaks of
+    all spectra are kept in flat typed arrays (mass, intensity, charge,
+    confidence and label for msalign; mz and intensity for mgf) and the peaks
+    of spectrum i are rows offsets[i]:offsets[i+1]. meta is a DataFrame with
+    one row of metadata per spectrum.
+    """
+    def __init__(self, meta, peaks, offsets):
+        self.meta = meta
+        self.peaks = peaks
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def peak_slice(self, i):
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def get_peaks(self, i, name):
+        """Return the values of one peak array of spectrum i (a view, not a copy)."""
+        return self.peaks[name][self.peak_slice(i)]
+
+    def spectrum(self, i):
+        """Return the metadata of spectrum i with views of its peak arrays."""
+        spectrum = self.meta.iloc[i].to_dict()
+        peak_range = self.peak_slice(i)
+        for name, values in self.peaks.items():
+            spectrum[name] = values[peak_range]
+        return spectrum
+
+    def nbytes(self):
+        return sum(values.nbytes for values in self.peaks.values()) + self.offsets.nbytes
+
+
+def combined_msalign_mgf_columns(ms2_columns, mgf_columns):
+    """
+    Columnar version of combined_msalign_mgf: merge the metadata of
+    SpectrumColumns from msalign and mgf. Returns a DataFrame with the
+    metadata and the spectrum numbers ms2_index and mgf_index (-1 if the
+    spectrum is not in the mgf file).
+    """
+    ms2_meta = ms2_columns.meta.assign(ms2_index=np.arange(len(ms2_columns)))
+    mgf_meta = mgf_columns.meta.assign(mgf_index=np.arange(len(mgf_columns)))
+    form_meta = ms2_meta.merge(mgf_meta,
+                               on=['dataset_id', 'mzml_file_name', 'scan'],
+                               how='left')
+    form_meta['mgf_index'] = form_meta['mgf_index'].fillna(-1).astype(np.int64)
+    return form_meta
+
+
 def combined_msalign_mgf(ms2_df, mgf_df):
     """
     merge MS2 data from msalign and centriod data from mgf into a Python DataFrame 
@@ -190,22 +327,123 @@ def combined_msalign_mgf(ms2_df, mgf_df):
     return form_df
     
 
+MGF_JOIN_FIELDS = ["title", "rtinseconds", "pepmass_mz", "charge", "mz_array", "intensity_array"]
+
+
+def iter_joined_rows(msalign_file, mgf_file, lookahead=1000):
+    """
+    Streaming version of combined_msalign_mgf. The msalign and mgf files are
+    read in step and one row dict is yielded for each msalign spectrum, with
+    the fields of its mgf spectrum. Both files are expected in scan order:
+    mgf spectra read ahead are kept in a buffer of at most lookahead spectra,
+    and a spectrum not found within lookahead spectra is read with the
+    spectrum index of the mgf file. If a key is duplicated in the mgf file,
+    the first spectrum is used. Unmatched spectra get empty peak lists. As
+    with the pandas merge, missing mgf fields (e.g. all fields of unmatched
+    spectra) are NaN and written as "CHARGE=nan" etc.
+    """
+    mgf_rows = iter_mgf_rows(mgf_file, buffering=1024*1024*16)
+    buffer = OrderedDict()
+    mgf_done = False
+    index = None
+    matched_count = 0
+    index_count = 0
+    missing_count = 0
+    try:
+        for row in iter_msalign_rows(msalign_file):
+            key = (row["dataset_id"], row["mzml_file_name"], row["scan"])
+            mgf_row = buffer.pop(key, None)
+            read_count = 0
+            while mgf_row is None and not mgf_done and read_count < lookahead:
+                next_row = next(mgf_rows, None)
+                if next_row is None:
+                    mgf_done = True
+                    break
+                read_count += 1
+                next_key = (next_row["dataset_id"], next_row["mzml_file_name"], next_row["scan"])
+                if next_key == key:
+                    mgf_row = next_row
+                elif next_key not in buffer:
+                    buffer[next_key] = next_row
+                    if len(buffer) > lookahead:
+                        buffer.popitem(last=False)
+            if mgf_row is None:
+                # the files are not in the same order, or the spectrum is missing
+                if index is None:
+                    index = spectrum_index.SpectrumIndex(mgf_file, file_format="mgf")
+                block = index.get(key[2], dataset_id=key[0], file_name=key[1])
+                if block is not None:
+                    for block_row in parse_mgf_lines(block.splitlines()):
+                        if (block_row["dataset_id"], block_row["mzml_file_name"], block_row["scan"]) == key:
+                            mgf_row = block_row
+                if mgf_row is not None:
+                    index_count += 1
+            if mgf_row is None:
+                missing_count += 1
+                mgf_row = {"mz_array": [], "intensity_array": []}
+            else:
+                matched_count += 1
+            for field in MGF_JOIN_FIELDS:
+                row[field] = mgf_row.get(field)
+                if row[field] is None:
+                    row[field] = np.nan
+            yield row
+    finally:
+        mgf_rows.close()
+        if index is not None:
+            index.close()
+    print(f"\nStreaming join: {matched_count} spectra matched ({index_count} read with the index), "
+          f"{missing_count} spectra not found in {mgf_file}")
+
+
+def load_annotation_input(msalign_file, mgf_file, columnar=False, stream=False):
+    """
+    Load and merge the msalign and mgf files of a run. Returns form_df and
+    columns: None, or (ms2_columns, mgf_columns) if columnar is True, in which
+    case form_df has no peak columns (see combined_msalign_mgf_columns).
+    If stream is True, form_df is the row iterator of iter_joined_rows and the
+    files are read while the spectra are annotated.
+    """
+    if stream:
+        return iter_joined_rows(msalign_file, mgf_file), None
+    ms2_data = load_msalign_data(msalign_file, columnar=columnar)
+    time_start = time.time()
+    mgf_data = load_mgf_data(mgf_file, columnar=columnar)
+    print(f"Loaded mgf data in {time.time() - time_start:.2f} seconds")
+    if columnar:
+        form_df = combined_msalign_mgf_columns(ms2_data, mgf_data)
+        print(f"Peak arrays: {(ms2_data.nbytes() + mgf_data.nbytes()) / 1024 / 1024:.2f} MB")
+        return form_df, (ms2_data, mgf_data)
+    return combined_msalign_mgf(ms2_data, mgf_data), None
+
+
 def process_one_spectrum(args):
     """
     Worker function: process ONE spectrum (one row of form_df)
     """
-    # row, theo_file, ppm_tol = args
+    # row, theo_file, ppm_tol, vectorized = args
     # Build a single-row DataFrame
-    row_dict, theo_file, ppm_tol = args
+    row_dict, theo_file, ppm_tol, vectorized = args
     form_df_one = pd.DataFrame([row_dict])
 
     # Run annotation
-    labels = mgf_anno.get_ms2_centroid_label(theo_file, form_df_one, ppm_tol)
-    labels = mgf_anno.filter_ms2_centroid_labels(labels)
+    if vectorized:
+        labels = mgf_anno.get_filtered_ms2_centroid_label_vectorized(theo_file, form_df_one, ppm_tol)
+    else:
+        labels = mgf_anno.get_ms2_centroid_label(theo_file, form_df_one, ppm_tol)
+        labels = mgf_anno.filter_ms2_centroid_labels(labels)
 
     # Extract result
     ms2_centroid_label = labels[0]
 
+    meta = build_mgf_meta(row_dict)
+    msalign_meta_lines = row_dict["meta_lines"]
+    peak_block = format_peak_block(row_dict["mz_array"], row_dict["intensity_array"], ms2_centroid_label)
+
+    return {"meta": meta, "peak_block": peak_block, "meta_lines": msalign_meta_lines}
+
+
+def build_mgf_meta(row_dict):
     # Build MGF output
     meta = {
         "DATASET_ID": row_dict["dataset_id"],
@@ -220,13 +458,24 @@ def process_one_spectrum(args):
         meta["PEPMASS_MZ"] = row_dict["pepmass_mz"]
     if row_dict["charge"] is not None:
         meta["CHARGE"] = row_dict["charge"]
-    
-    msalign_meta_lines = row_dict["meta_lines"]
+    return meta
+
 
-    peaks_out = []
-    for mz, inten, annot in zip(row_dict["mz_array"], row_dict["intensity_array"], ms2_centroid_label):
+PEAK_FORMAT = "%s %s\n"
+ANNOTATED_PEAK_FORMAT = "%.5f %.2f %d %.5f %d %.5f %s %d %.2f %.3f %s\n"
+
+
+def format_peak_block(mz_array, intensity_array, ms2_centroid_label):
+    """
+    Return the peak lines of an annotated spectrum as one string, formatted
+    at once with peak_format.format_peak_rows.
+    """
+    templates = []
+    values = []
+    for mz, inten, annot in zip(peak_format.as_list(mz_array), peak_format.as_list(intensity_array), ms2_centroid_label):
         if annot == "" or annot is None:
-            peaks_out.append(f"{mz} {inten}")
+            templates.append(PEAK_FORMAT)
+            values += (mz, inten)
         else:
             (
                 exp_int,
@@ -241,14 +490,300 @@ def process_one_spectrum(args):
                 label
             ) = annot
             
-            peaks_out.append(
-                f"{mz:.5f} {inten:.2f} {ms2_id+1:d} {theo_mass:.5f} "
-                f"{ch:d} {theo_mz:.5f} {inte_flag} {idx + 1:d} "
-                f"{theo_intensity:.2f} {inte_per:.3f} {label}"
-            )
+            templates.append(ANNOTATED_PEAK_FORMAT)
+            values += (mz, inten, ms2_id + 1, theo_mass, ch, theo_mz, inte_flag, idx + 1,
+                       theo_intensity, inte_per, label)
+    return peak_format.format_peak_rows(templates, values)
+
+
+def format_mgf_block(meta, meta_lines, peak_block):
+    """Return the text of one annotated spectrum in the annotated MGF file."""
+    lines = ["BEGIN IONS"]
+    for k, v in meta.items():
+        lines.append(f"{k}={v}")
+    lines.extend(meta_lines)
+    return "\n".join(lines) + "\n" + peak_block + "END IONS\n\n"
+
+
+# ---------- BATCHED SHARED MEMORY PROTOCOL ----------
+# Peak arrays of a chunk of spectra are flattened into one shared memory
+# block (deconv_offsets and centroid_offsets give the peaks of each
+# spectrum). Workers annotate the chunk on the arrays and return the MGF text.
+CHUNK_ARRAYS = [
+    ("mass", np.float64),
+    ("intensity", np.float64),
+    ("charge", np.int64),
+    ("deconv_offsets", np.int64),
+    ("mz", np.float64),
+    ("centroid_intensity", np.float64),
+    ("centroid_offsets", np.int64),
+    ("labels", np.uint8)
+]
+
+
+def as_list(value):
+    # missing values (e.g. no matching mgf spectrum) become empty lists
+    value = mgf_anno.safe_json_load(value)
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return value
+    return []
+
+
+def pack_spectrum_chunk(row_dicts):
+    """
+    Copy the peaks of a chunk of spectra (rows of form_df) into a new shared
+    memory block. Returns the SharedMemory object, which the caller must
+    unlink, and the task for process_spectrum_chunk.
+    """
+    values = {name: [] for name, _ in CHUNK_ARRAYS}
+    values["deconv_offsets"].append(0)
+    values["centroid_offsets"].append(0)
+    labels = []
+    headers = []
+    for row_dict in row_dicts:
+        masses = as_list(row_dict["mass_all"])
+        values["mass"].extend(masses)
+        values["intensity"].extend(as_list(row_dict["intensity_all"]))
+        values["charge"].extend(as_list(row_dict["charge_all"]))
+        values["deconv_offsets"].append(values["deconv_offsets"][-1] + len(masses))
+        mzs = as_list(row_dict["mz_array"])
+        values["mz"].extend(mzs)
+        values["centroid_intensity"].extend(as_list(row_dict["intensity_array"]))
+        values["centroid_offsets"].append(values["centroid_offsets"][-1] + len(mzs))
+        labels.extend(as_list(row_dict["ms2_deconv_label"]))
+        headers.append((build_mgf_meta(row_dict), row_dict["meta_lines"]))
+    arrays = {name: np.array(values[name], dtype=dtype) for name, dtype in CHUNK_ARRAYS if name != "labels"}
+    arrays["labels"] = np.frombuffer("\n".join(labels).encode("utf-8"), dtype=np.uint8)
+    return write_chunk_arrays(arrays, headers)
+
+
+def pack_columnar_chunk(ms2_columns, mgf_columns, form_rows):
+    """
+    Same as pack_spectrum_chunk for spectra in SpectrumColumns. form_rows are
+    rows of combined_msalign_mgf_columns; peaks are copied from the flat arrays.
+    """
+    deconv_ranges = [ms2_columns.peak_slice(row_dict["ms2_index"]) for row_dict in form_rows]
+    centroid_ranges = [mgf_columns.peak_slice(row_dict["mgf_index"]) if row_dict["mgf_index"] >= 0 else slice(0, 0)
+                       for row_dict in form_rows]
+
+    def gather(peaks, name, ranges, dtype):
+        if not ranges:
+            return np.zeros(0, dtype=dtype)
+        return np.concatenate([peaks[name][r] for r in ranges]).astype(dtype, copy=False)
+
+    def range_offsets(ranges):
+        return np.concatenate(([0], np.cumsum([r.stop - r.start for r in ranges]))).astype(np.int64)
+
+    arrays = {
+        "mass": gather(ms2_columns.peaks, "mass", deconv_ranges, np.float64),
+        "intensity": gather(ms2_columns.peaks, "intensity", deconv_ranges, np.float64),
+        "charge": gather(ms2_columns.peaks, "charge", deconv_ranges, np.int64),
+        "deconv_offsets": range_offsets(deconv_ranges),
+        "mz": gather(mgf_columns.peaks, "mz", centroid_ranges, np.float64),
+        "centroid_intensity": gather(mgf_columns.peaks, "intensity", centroid_ranges, np.float64),
+        "centroid_offsets": range_offsets(centroid_ranges)
+    }
+    labels = gather(ms2_columns.peaks, "label", deconv_ranges, object).tolist()
+    arrays["labels"] = np.frombuffer("\n".join(labels).encode("utf-8"), dtype=np.uint8)
+    headers = [(build_mgf_meta(row_dict), row_dict["meta_lines"]) for row_dict in form_rows]
+    return write_chunk_arrays(arrays, headers)
+
+
+def write_chunk_arrays(arrays, headers):
+    layout = []
+    offset = 0
+    for name, dtype in CHUNK_ARRAYS:
+        layout.append((name, np.dtype(dtype).str, offset, len(arrays[name])))
+        offset += arrays[name].nbytes
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for name, dtype_str, array_offset, length in layout:
+        view = np.ndarray((length,), dtype=dtype_str, buffer=shm.buf, offset=array_offset)
+        view[:] = arrays[name]
+        del view
+    return shm, (shm.name, layout, headers)
+
+
+def process_spectrum_chunk(args):
+    """
+    Worker function: annotate a chunk of spectra packed by pack_spectrum_chunk
+    and return the MGF text of the chunk and the number of spectra.
+    """
+    (shm_name, layout, headers), theo_file, ppm_tol, vectorized = args
+    if vectorized:
+        env_arrays = mgf_anno.get_theo_envelope_arrays_cached(theo_file)
+    else:
+        envelopes, mono_mass_list = mgf_anno.get_theo_envelopes_cached(theo_file)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        arrays = {}
+        for name, dtype_str, array_offset, length in layout:
+            arrays[name] = np.ndarray((length,), dtype=dtype_str, buffer=shm.buf, offset=array_offset)
+        # tolist gives Python floats, the same values as the per spectrum path
+        masses = arrays["mass"].tolist()
+        intensities = arrays["intensity"].tolist()
+        charges = arrays["charge"].tolist()
+        deconv_offsets = arrays["deconv_offsets"].tolist()
+        mzs = arrays["mz"].tolist()
+        centroid_intensities = arrays["centroid_intensity"].tolist()
+        centroid_offsets = arrays["centroid_offsets"].tolist()
+        labels = bytes(arrays["labels"]).decode("utf-8").split("\n") if len(masses) > 0 else []
+        del arrays
+    finally:
+        shm.close()
+
+    blocks = []
+    for k, (meta, meta_lines) in enumerate(headers):
+        d_begin, d_end = deconv_offsets[k], deconv_offsets[k + 1]
+        c_begin, c_end = centroid_offsets[k], centroid_offsets[k + 1]
+        mz_list = mzs[c_begin:c_end]
+        inte_list = centroid_intensities[c_begin:c_end]
+        if vectorized:
+            ms2_centroid_label = mgf_anno.annotate_centroid_peaks_vectorized(
+                env_arrays, masses[d_begin:d_end], intensities[d_begin:d_end], charges[d_begin:d_end],
+                mz_list, inte_list, labels[d_begin:d_end], ppm_tol)
+        else:
+            ms2_centroid_label = mgf_anno.annotate_centroid_peaks(
+                envelopes, mono_mass_list, masses[d_begin:d_end], intensities[d_begin:d_end], charges[d_begin:d_end],
+                mz_list, inte_list, labels[d_begin:d_end], ppm_tol)
+            ms2_centroid_label = mgf_anno.filter_ms2_centroid_labels([ms2_centroid_label])[0]
+        peak_block = format_peak_block(mz_list, inte_list, ms2_centroid_label)
+        blocks.append(format_mgf_block(meta, meta_lines, peak_block))
+    return "".join(blocks), len(headers)
 
 
-    return {"meta": meta, "peaks": peaks_out, "meta_lines": msalign_meta_lines}
+def create_chunk_pool(num_workers):
+    # start the resource tracker before the workers, so that they share it with
+    # the parent and the blocks they attach are not reported as leaked
+    resource_tracker.ensure_running()
+    return Pool(num_workers)
 
 
+def iter_packed_chunks(form_df, chunk_size=200, columns=None):
+    """
+    Yield (shm, task) for the chunks of chunk_size spectra of form_df (a
+    DataFrame or an iterable of row dicts). A chunk is only read and packed
+    when the next item is requested. If columns is (ms2_columns, mgf_columns),
+    form_df is from combined_msalign_mgf_columns and peaks are read from the
+    SpectrumColumns.
+    """
+    if isinstance(form_df, pd.DataFrame):
+        rows = (row._asdict() for row in form_df.itertuples(index=False))
+    else:
+        # row dicts, e.g. from iter_joined_rows
+        rows = iter(form_df)
+    while True:
+        chunk = [row_dict for _, row_dict in zip(range(chunk_size), rows)]
+        if not chunk:
+            return
+        if columns is None:
+            yield pack_spectrum_chunk(chunk)
+        else:
+            yield pack_columnar_chunk(columns[0], columns[1], chunk)
 
+
+def iter_chunk_results(tagged_chunks, theo_file, ppm_tol, pool, num_workers, max_inflight=None, vectorized=False):
+    """
+    Annotate packed chunks on pool (from create_chunk_pool). tagged_chunks is
+    an iterator of (tag, shm, task); (tag, MGF text, number of spectra) is
+    yielded for each chunk in the same order. Items with shm None are markers,
+    yielded in order as (tag, None, 0). At most max_inflight items (default:
+    2 * num_workers) are taken ahead of the caller.
+    """
+    max_inflight = max_inflight or 2 * num_workers
+    pending = deque()
+    tagged_chunks = iter(tagged_chunks)
+    try:
+        while True:
+            while len(pending) < max_inflight:
+                item = next(tagged_chunks, None)
+                if item is None:
+                    break
+                tag, shm, task = item
+                if shm is None:
+                    pending.append((tag, None, None))
+                else:
+                    pending.append((tag, shm, pool.apply_async(process_spectrum_chunk, ((task, theo_file, ppm_tol, vectorized),))))
+            if not pending:
+                break
+            tag, shm, result = pending.popleft()
+            if shm is None:
+                yield tag, None, 0
+                continue
+            try:
+                text, count = result.get()
+            finally:
+                shm.close()
+                shm.unlink()
+            yield tag, text, count
+    finally:
+        for _, shm, _ in pending:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+
+def iter_annotated_chunks(form_df, theo_file, ppm_tol, pool, num_workers, chunk_size=200, max_inflight=None,
+                          vectorized=False, columns=None):
+    """
+    Annotate the spectra of form_df (a DataFrame or an iterable of row dicts)
+    on pool (from create_chunk_pool) with the shared memory protocol and
+    yield (MGF text, number of spectra) for each chunk in the order of form_df.
+    See iter_packed_chunks and iter_chunk_results.
+    """
+    tagged_chunks = ((None, shm, task) for shm, task in iter_packed_chunks(form_df, chunk_size, columns))
+    for _, text, count in iter_chunk_results(tagged_chunks, theo_file, ppm_tol, pool, num_workers,
+                                             max_inflight=max_inflight, vectorized=vectorized):
+        yield text, count
+
+
+# ---------- CHECKPOINTS ----------
+# Same protocol as process.msalign.checkpoint: the annotated mgf file is
+# written to <out>.part, and the number of form_df rows written, the key of
+# the last one and the size of the output are saved in <out>.ckpt.
+def spectrum_key(meta):
+    # meta from build_mgf_meta
+    return [str(meta["DATASET_ID"]), str(meta["MZML_FILE_NAME"]), str(meta["SCAN"])]
+
+
+def chunk_key(task):
+    # key of the last spectrum of a chunk packed by pack_spectrum_chunk
+    headers = task[2]
+    return spectrum_key(headers[-1][0])
+
+
+def skip_form_rows(form_df, count):
+    """
+    Skip the first count rows of form_df (a DataFrame or an iterable of row
+    dicts). Returns the remaining rows and the key of the last skipped row.
+    """
+    if count == 0:
+        return form_df, None
+    if isinstance(form_df, pd.DataFrame):
+        if len(form_df) < count:
+            raise ValueError(f"The input has fewer than {count} spectra")
+        row = form_df.iloc[count - 1]
+        return form_df.iloc[count:], [str(row["dataset_id"]), str(row["mzml_file_name"]), str(row["scan"])]
+    rows = iter(form_df)
+    row = None
+    for _ in range(count):
+        row = next(rows, None)
+        if row is None:
+            raise ValueError(f"The input has fewer than {count} spectra")
+    return rows, [str(row["dataset_id"]), str(row["mzml_file_name"]), str(row["scan"])]
+
+
+class AnnotationCheckpoint(checkpoint.CheckpointWriter):
+    """
+    Checkpoints of an annotated mgf file, see
+    process.msalign.checkpoint.CheckpointWriter. The input is skipped by
+    form_df rows and open() returns the output file (<out_file>.part).
+    """
+    def skip_input(self, form_df):
+        """Return the rows of form_df that are not annotated yet."""
+        rows, key = skip_form_rows(form_df, self.state["input_count"])
+        if key != self.state["key"]:
+            raise ValueError(f"Checkpoint {self.checkpoint_file} does not match the input files")
+        return rows
+
+    def open(self, buffering=1024*1024*1024):
+        return open(self.part_file, "a", encoding="utf-8", buffering=buffering)
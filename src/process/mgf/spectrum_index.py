@@ -0,0 +1,239 @@
+import os
+import sys
+import json
+import numpy as np
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".idx.npz"
+
+# meta keys used for (DATASET_ID, file name, scan), in order of preference
+KEY_FIELDS = {
+    "msalign": {
+        "dataset_id": ["DATASET_ID"],
+        "file_name": ["MSALIGN_FILE_NAME", "FILE_NAME"],
+        "scan": ["MS2_SCAN", "SCANS"]
+    },
+    "mgf": {
+        "dataset_id": ["DATASET_ID"],
+        "file_name": ["MZML_FILE_NAME"],
+        "scan": ["SCAN", "SCANS"]
+    }
+}
+
+
+def guess_file_format(spectrum_file):
+    if spectrum_file.lower().endswith(".mgf"):
+        return "mgf"
+    return "msalign"
+
+
+class SpectrumIndex():
+    """
+    Byte offset index of the spectra (BEGIN IONS/END IONS blocks) in an
+    msalign or mgf file. The index is built in one pass and saved next to the
+    spectrum file (<spectrum_file>.idx.npz), or in index_dir. It is rebuilt
+    when the size or the modification time of the spectrum file changes. If
+    the index file cannot be written (e.g. a read-only folder), the index
+    is only kept in memory.
+
+    Usage:
+        with SpectrumIndex("spectra_ms2.msalign") as index:
+            block = index.get(1234)
+            blocks = index.get_many([1234, 1240])
+    """
+    def __init__(self, spectrum_file, file_format=None, index_file=None, rebuild=False, index_dir=None):
+        self.spectrum_file = spectrum_file
+        self.file_format = file_format or guess_file_format(spectrum_file)
+        if self.file_format not in KEY_FIELDS:
+            raise ValueError(f"Invalid file format: {self.file_format}. Choose 'msalign' or 'mgf'.")
+        if index_file is None and index_dir is not None:
+            index_file = os.path.join(index_dir, os.path.basename(spectrum_file) + INDEX_SUFFIX)
+        self.index_file = index_file or spectrum_file + INDEX_SUFFIX
+        self.f = None
+        self.saved = True
+        if rebuild or not self.load():
+            self.build()
+            self.saved = self.save()
+        # sorted scans for searchsorted lookups
+        self.scan_order = np.argsort(self.scans, kind="stable")
+        self.sorted_scans = self.scans[self.scan_order]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def file_stat(self):
+        stat = os.stat(self.spectrum_file)
+        return stat.st_size, stat.st_mtime_ns
+
+    def build(self):
+        fields = KEY_FIELDS[self.file_format]
+        key_prefixes = {}
+        for key, names in fields.items():
+            for rank, name in enumerate(names):
+                key_prefixes[(name + "=").encode()] = (key, rank)
+        offsets = []
+        lengths = []
+        scans = []
+        dataset_ids = []
+        file_names = []
+        pos = 0
+        begin = None
+        current = None
+        with open(self.spectrum_file, "rb", buffering=1024*1024*16) as fh:
+            for line in fh:
+                stripped = line.strip()
+                if stripped == b"BEGIN IONS":
+                    begin = pos
+                    current = {}
+                elif stripped == b"END IONS":
+                    if current is not None and "scan" in current:
+                        offsets.append(begin)
+                        lengths.append(pos + len(line) - begin)
+                        scans.append(current["scan"][1])
+                        dataset_ids.append(current.get("dataset_id", (0, ""))[1])
+                        file_names.append(current.get("file_name", (0, ""))[1])
+                    current = None
+                elif current is not None and b"=" in stripped:
+                    prefix = stripped[:stripped.find(b"=") + 1]
+                    if prefix in key_prefixes:
+                        key, rank = key_prefixes[prefix]
+                        # keep the preferred meta key when both are present
+                        if key not in current or rank < current[key][0]:
+                            value = stripped[len(prefix):].decode("utf-8", errors="ignore")
+                            if key == "scan":
+                                value = int(value.split()[0])
+                            elif key == "file_name":
+                                value = os.path.basename(value)
+                            current[key] = (rank, value)
+                pos += len(line)
+        self.size, self.mtime_ns = self.file_stat()
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.lengths = np.array(lengths, dtype=np.int64)
+        self.scans = np.array(scans, dtype=np.int64)
+        # dataset ids and file names are stored as codes into small tables
+        self.dataset_id_list, self.dataset_codes = self.encode_strings(dataset_ids)
+        self.file_name_list, self.file_codes = self.encode_strings(file_names)
+
+    @staticmethod
+    def encode_strings(values):
+        names = sorted(set(values))
+        code_map = {name: code for code, name in enumerate(names)}
+        codes = np.array([code_map[v] for v in values], dtype=np.int32)
+        return names, codes
+
+    def save(self):
+        header = {
+            "version": INDEX_VERSION,
+            "format": self.file_format,
+            "size": self.size,
+            "mtime_ns": self.mtime_ns,
+            "dataset_ids": self.dataset_id_list,
+            "file_names": self.file_name_list
+        }
+        # return False if the index file cannot be written
+        tmp_file = self.index_file + ".tmp.npz"
+        try:
+            np.savez(tmp_file, header=np.array(json.dumps(header)), offsets=self.offsets, lengths=self.lengths,
+                     scans=self.scans, dataset_codes=self.dataset_codes, file_codes=self.file_codes)
+            os.replace(tmp_file, self.index_file)
+        except OSError as e:
+            print(f"Warning: cannot save the spectrum index {self.index_file} ({e}), the index is kept in memory.")
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+            return False
+        return True
+
+    def load(self):
+        # return False if the index file is missing or out of date
+        if not os.path.isfile(self.index_file):
+            return False
+        try:
+            with np.load(self.index_file, allow_pickle=False) as data:
+                header = json.loads(str(data["header"]))
+                if header["version"] != INDEX_VERSION or header["format"] != self.file_format:
+                    return False
+                if (header["size"], header["mtime_ns"]) != self.file_stat():
+                    return False
+                self.size = header["size"]
+                self.mtime_ns = header["mtime_ns"]
+                self.dataset_id_list = header["dataset_ids"]
+                self.file_name_list = header["file_names"]
+                self.offsets = data["offsets"]
+                self.lengths = data["lengths"]
+                self.scans = data["scans"]
+                self.dataset_codes = data["dataset_codes"]
+                self.file_codes = data["file_codes"]
+        except (OSError, ValueError, KeyError):
+            return False
+        return True
+
+    def keys(self):
+        """Return the list of (DATASET_ID, file name, scan) in file order."""
+        return [(self.dataset_id_list[d], self.file_name_list[f], int(s))
+                for d, f, s in zip(self.dataset_codes, self.file_codes, self.scans)]
+
+    def find(self, scan, dataset_id=None, file_name=None):
+        """Return the entry numbers of a scan, in file order."""
+        lo = np.searchsorted(self.sorted_scans, scan, side="left")
+        hi = np.searchsorted(self.sorted_scans, scan, side="right")
+        entries = self.scan_order[lo:hi]
+        if dataset_id is not None:
+            if dataset_id not in self.dataset_id_list:
+                return entries[:0]
+            entries = entries[self.dataset_codes[entries] == self.dataset_id_list.index(dataset_id)]
+        if file_name is not None:
+            if file_name not in self.file_name_list:
+                return entries[:0]
+            entries = entries[self.file_codes[entries] == self.file_name_list.index(file_name)]
+        return entries
+
+    def read_entry(self, entry):
+        if self.f is None:
+            self.f = open(self.spectrum_file, "rb")
+        self.f.seek(int(self.offsets[entry]))
+        return self.f.read(int(self.lengths[entry])).decode("utf-8", errors="ignore")
+
+    def get(self, scan, dataset_id=None, file_name=None):
+        """
+        Return the text of the spectrum block (BEGIN IONS to END IONS) of a
+        scan, or None if the scan is not in the file. If several spectra match,
+        the first one in the file is returned.
+        """
+        entries = self.find(scan, dataset_id=dataset_id, file_name=file_name)
+        if len(entries) == 0:
+            return None
+        return self.read_entry(entries[0])
+
+    def get_many(self, scans, dataset_id=None, file_name=None):
+        """
+        Return a dict {scan: spectrum block} for the scans found in the file.
+        Blocks are read in file order to keep the seeks sequential.
+        """
+        found = []
+        for scan in set(scans):
+            entries = self.find(scan, dataset_id=dataset_id, file_name=file_name)
+            if len(entries) > 0:
+                found.append((int(entries[0]), scan))
+        found.sort()
+        return {scan: self.read_entry(entry) for entry, scan in found}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python script.py <msalign_or_mgf_filename> [<msalign_or_mgf_filename> ...]")
+        sys.exit(1)
+    for spectrum_file in sys.argv[1:]:
+        index = SpectrumIndex(spectrum_file, rebuild=True)
+        if index.saved:
+            print(f"Indexed {len(index)} spectra in {spectrum_file}. Saved to: {index.index_file}")
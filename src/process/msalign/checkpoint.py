@@ -0,0 +1,105 @@
+import os
+import json
+import mmap
+
+PARTIAL_SUFFIX = ".part"
+CHECKPOINT_SUFFIX = ".ckpt"
+# meta keys of the spectrum key recorded in checkpoints
+KEY_FIELDS = ["DATASET_ID", "MSALIGN_FILE_NAME", "MS2_SCAN", "SCANS"]
+
+
+def spectrum_key(meta):
+    return [meta.get(field, "") for field in KEY_FIELDS]
+
+
+def skip_spectra(msalign_file, count):
+    """
+    Return the byte offset after the first count spectra of a msalign file
+    and the key of the last one. Only the header of the last spectrum is
+    parsed, the other blocks are skipped by searching BEGIN IONS/END IONS.
+    """
+    if count == 0:
+        return 0, None
+    with open(msalign_file, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        pos = 0
+        begin = -1
+        for _ in range(count):
+            begin = mm.find(b"BEGIN IONS", pos)
+            end = mm.find(b"END IONS", begin) if begin >= 0 else -1
+            if end < 0:
+                raise ValueError(f"{msalign_file} has fewer than {count} spectra")
+            pos = end + len(b"END IONS")
+        meta = {}
+        for line in mm[begin:pos].decode("utf-8").splitlines():
+            if "=" in line:
+                key, val = line.strip().split("=", 1)
+                meta[key] = val
+    finally:
+        mm.close()
+    return pos, spectrum_key(meta)
+
+
+class CheckpointWriter():
+    """
+    Checkpoints of an output file. The output is written to
+    <output_file>.part and every interval input spectra the number of input
+    spectra processed, the key of the last one and the size of the flushed
+    output are saved in <output_file>.ckpt. finish() renames the .part file
+    to output_file and removes the checkpoint.
+
+    With resume, the .part file is truncated to the last checkpoint and
+    input_count spectra of the input are skipped by the caller (see
+    skip_spectra).
+    """
+    def __init__(self, output_file, resume=False, interval=1000):
+        self.output_file = output_file
+        self.part_file = output_file + PARTIAL_SUFFIX
+        self.checkpoint_file = output_file + CHECKPOINT_SUFFIX
+        self.interval = interval
+        self.state = {"input_count": 0, "key": None, "output_offset": 0}
+        if resume and os.path.isfile(self.checkpoint_file) and os.path.isfile(self.part_file):
+            with open(self.checkpoint_file, "r") as f:
+                self.state = json.load(f)
+            with open(self.part_file, "r+b") as f:
+                f.truncate(self.state["output_offset"])
+            print(f"Resuming {output_file} after {self.state['input_count']} input spectra")
+        else:
+            open(self.part_file, "wb").close()
+            if os.path.isfile(self.checkpoint_file):
+                os.remove(self.checkpoint_file)
+        self.last_count = self.state["input_count"]
+
+    @property
+    def input_count(self):
+        return self.state["input_count"]
+
+    def skip_input(self, msalign_file):
+        """Return the byte offset of the first input spectrum that is not processed."""
+        offset, key = skip_spectra(msalign_file, self.state["input_count"])
+        if key != self.state["key"]:
+            raise ValueError(f"Checkpoint {self.checkpoint_file} does not match {msalign_file}")
+        return offset
+
+    def update(self, f, input_count, key):
+        # f is the output file object, called after the output of input
+        # spectrum input_count is written
+        if input_count - self.last_count < self.interval:
+            return
+        self.save(f, input_count, key)
+
+    def save(self, f, input_count, key):
+        f.flush()
+        os.fsync(f.fileno())
+        self.state = {"input_count": input_count, "key": key, "output_offset": os.fstat(f.fileno()).st_size}
+        tmp_file = self.checkpoint_file + ".tmp"
+        with open(tmp_file, "w") as ckpt_f:
+            json.dump(self.state, ckpt_f)
+        os.replace(tmp_file, self.checkpoint_file)
+        self.last_count = input_count
+
+    def finish(self):
+        os.replace(self.part_file, self.output_file)
+        if os.path.isfile(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
\ No newline at end of file
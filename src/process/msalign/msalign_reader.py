@@ -1,11 +1,224 @@
-from torch.utils.data import Dataset as DataSet
+import os
+import mmap
+import numpy as np
 
-class MsalignReader(DataSet):
+class MsalignSpectrumView():
+    """
+    A spectrum in a memory-mapped msalign file. Header lines are decoded only
+    when meta or meta_lines is used, and the peak lines are kept as a raw 
+    memoryview (peak_block) that writers can copy without parsing. The view 
+    supports spectrum["meta"], spectrum["meta_lines"] and spectrum["peak_lines"]
+    like the dicts returned by readmsalign_iter. Header lines are expected 
+    before the peak lines in each spectrum. peak_block is None when the raw
+    lines differ from the stripped peak_lines (e.g. CRLF line endings), so
+    writers output the same text as with readmsalign_iter.
+    """
+    def __init__(self, mm, header_begin, header_end, peak_begin, peak_end):
+        self.mm = mm
+        self.header_begin = header_begin
+        self.header_end = header_end
+        self.peak_begin = peak_begin
+        self.peak_end = peak_end
+        self._meta = None
+        self._meta_lines = None
+        self._peak_lines = None
+
+    @property
+    def meta_lines(self):
+        if self._meta_lines is None:
+            header = self.mm[self.header_begin:self.header_end].decode("utf-8")
+            self._meta_lines = [line.strip() for line in header.splitlines() if line.strip()]
+        return self._meta_lines
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            self._meta = {}
+            for line in self.meta_lines:
+                key, val = line.split("=", 1)
+                self._meta[key] = val
+        return self._meta
+
+    @property
+    def peak_block(self):
+        # None after the peak lines have been replaced
+        if self._peak_lines is not None:
+            return None
+        if not is_normalized_block(self.mm, self.peak_begin, self.peak_end):
+            return None
+        return memoryview(self.mm)[self.peak_begin:self.peak_end]
+
+    @property
+    def peak_lines(self):
+        if self._peak_lines is None:
+            block = self.mm[self.peak_begin:self.peak_end].decode("utf-8")
+            return [line.strip() for line in block.splitlines() if line.strip()]
+        return self._peak_lines
+
+    @peak_lines.setter
+    def peak_lines(self, lines):
+        self._peak_lines = lines
+
+    def __getitem__(self, key):
+        if key not in ("meta", "meta_lines", "peak_lines", "peak_block"):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key != "peak_lines":
+            raise KeyError(key)
+        self.peak_lines = value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+def is_normalized_block(mm, begin, end):
+    """
+    Return True if the peak lines mm[begin:end] are the same as their
+    stripped, non-empty lines each followed by "\n": LF line endings, no
+    blank lines and no leading or trailing whitespace.
+    """
+    if begin == end:
+        return True
+    if mm[end - 1:end] != b"\n" or mm[begin:begin + 1].isspace() or mm[end - 2:end - 1].isspace():
+        return False
+    if mm.find(b"\r", begin, end) >= 0 or mm.find(b"\n\n", begin, end) >= 0:
+        return False
+    for ws in (b" ", b"\t", b"\x0b", b"\x0c"):
+        if mm.find(ws + b"\n", begin, end) >= 0 or mm.find(b"\n" + ws, begin, end) >= 0:
+            return False
+    return True
+
+
+def parse_spectrum_block(block):
+    """
+    Parse the text of one BEGIN IONS/END IONS block into the same dict as
+    readmsalign_iter
+    """
+    current = {"meta": {}, "meta_lines": [], "peak_lines": []}
+    for line in block.splitlines():
+        line = line.strip()
+        if not line or line.startswith("BEGIN IONS") or line.startswith("END IONS"):
+            continue
+        if "=" in line:
+            key, val = line.split("=", 1)
+            current["meta"][key] = val
+            current["meta_lines"].append(line)
+        else:
+            current["peak_lines"].append(line)
+    return current
+
+
+def collate_spectra(spectra, max_peaks=None):
+    """
+    Batch the peak lists of spectra into padded numpy arrays for ML training.
+    Returns a dict with arrays of shape (batch size, max number of peaks):
+    mass, intensity, charge, score and mask (True for real peaks), plus
+    num_peaks and the list of meta dicts. Peaks after max_peaks are dropped.
+    """
+    peak_lists = []
+    for spectrum in spectra:
+        peaks = []
+        for line in spectrum["peak_lines"]:
+            parts = line.split()
+            if len(parts) >= 3:
+                score = float(parts[3]) if len(parts) > 3 else np.nan
+                peaks.append((float(parts[0]), float(parts[1]), int(parts[2]), score))
+        if max_peaks is not None:
+            peaks = peaks[:max_peaks]
+        peak_lists.append(peaks)
+    batch_size = len(peak_lists)
+    num_peaks = np.array([len(peaks) for peaks in peak_lists], dtype=np.int64)
+    width = int(num_peaks.max()) if batch_size > 0 else 0
+    batch = {
+        "mass": np.zeros((batch_size, width), dtype=np.float64),
+        "intensity": np.zeros((batch_size, width), dtype=np.float64),
+        "charge": np.zeros((batch_size, width), dtype=np.int32),
+        "score": np.zeros((batch_size, width), dtype=np.float64),
+        "mask": np.arange(width) < num_peaks[:, None],
+        "num_peaks": num_peaks,
+        "meta": [spectrum["meta"] for spectrum in spectra]
+    }
+    for row, peaks in enumerate(peak_lists):
+        if peaks:
+            n = len(peaks)
+            mass, intensity, charge, score = zip(*peaks)
+            batch["mass"][row, :n] = mass
+            batch["intensity"][row, :n] = intensity
+            batch["charge"][row, :n] = charge
+            batch["score"][row, :n] = score
+    return batch
+
+
+class MsalignReader():
+    """
+    Reader of msalign files. readmsalign_iter streams the spectra; len() and
+    reader[i] give random access to the i-th spectrum through the byte
+    offsets of the spectrum blocks, which are found on first use. Use
+    msalign_torch.MsalignTorchDataset for a torch Dataset.
+    """
     def __init__(self, msalign_file): 
         self.msalign_file = msalign_file
+        self.mm = None
+        self.block_begins = None
+        self.block_ends = None
+
+    def __getstate__(self):
+        # the memory map is reopened in each process (e.g. DataLoader workers)
+        state = self.__dict__.copy()
+        state["mm"] = None
+        return state
 
-    def readmsalign_iter(self):
+    def open_mmap(self):
+        if self.mm is None:
+            with open(self.msalign_file, "rb") as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mm
+
+    def build_block_offsets(self):
+        begins = []
+        ends = []
+        if os.path.getsize(self.msalign_file) > 0:
+            mm = self.open_mmap()
+            pos = 0
+            while True:
+                begin = mm.find(b"BEGIN IONS", pos)
+                if begin < 0:
+                    break
+                end = mm.find(b"END IONS", begin)
+                if end < 0:
+                    break
+                pos = end + len(b"END IONS")
+                begins.append(begin)
+                ends.append(pos)
+        self.block_begins = np.array(begins, dtype=np.int64)
+        self.block_ends = np.array(ends, dtype=np.int64)
+
+    def __len__(self):
+        if self.block_begins is None:
+            self.build_block_offsets()
+        return len(self.block_begins)
+
+    def __getitem__(self, idx):
+        n = len(self)
+        if idx < 0:
+            idx += n
+        if idx < 0 or idx >= n:
+            raise IndexError(f"spectrum index {idx} out of range")
+        mm = self.open_mmap()
+        block = mm[self.block_begins[idx]:self.block_ends[idx]].decode("utf-8")
+        return parse_spectrum_block(block)
+
+    def readmsalign_iter(self, start_offset=0):
+        # start_offset is a byte offset of a spectrum block, e.g. from
+        # checkpoint.skip_spectra
         f = open(self.msalign_file, "r", buffering=1024*1024*1024)
+        if start_offset > 0:
+            f.seek(start_offset)
         current = None
         for line in f:
             line = line.strip()
@@ -24,4 +237,43 @@ class MsalignReader(DataSet):
                     current["meta_lines"].append(line)
                 else:
                     # Each line should be: mz intensity ion_type
-                    current["peak_lines"].append(line)
\ No newline at end of file
+                    current["peak_lines"].append(line)
+
+    def readmsalign_mmap_iter(self, start_offset=0):
+        """
+        Memory-map the msalign file and yield a MsalignSpectrumView for each 
+        BEGIN IONS/END IONS block after the byte offset start_offset.
+        """
+        with open(self.msalign_file, "rb") as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                return
+        # mm is not closed here: views yielded to the caller may still
+        # reference it, it is released when the last view is gone
+        pos = start_offset
+        while True:
+            begin = mm.find(b"BEGIN IONS", pos)
+            if begin < 0:
+                break
+            end = mm.find(b"END IONS", begin)
+            if end < 0:
+                break
+            header_begin = mm.find(b"\n", begin, end) + 1
+            if header_begin == 0:
+                header_begin = end
+            # header lines contain "=", the peak block starts at the first
+            # non-empty line without "="
+            line_begin = header_begin
+            peak_begin = end
+            while line_begin < end:
+                line_end = mm.find(b"\n", line_begin, end)
+                if line_end < 0:
+                    line_end = end
+                if mm.find(b"=", line_begin, line_end) < 0 and mm[line_begin:line_end].strip():
+                    peak_begin = line_begin
+                    break
+                line_begin = line_end + 1
+            yield MsalignSpectrumView(mm, header_begin, peak_begin, peak_begin, end)
+            pos = end + len(b"END IONS")
\ No newline at end of file
@@ -0,0 +1,18 @@
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from process.msalign import msalign_reader
+
+
+class MsalignTorchDataset(msalign_reader.MsalignReader, Dataset):
+    """Map-style torch Dataset of the spectra in an msalign file."""
+    pass
+
+
+def torch_collate_spectra(spectra, max_peaks=None):
+    """Same as msalign_reader.collate_spectra, with torch tensors."""
+    batch = msalign_reader.collate_spectra(spectra, max_peaks=max_peaks)
+    for key, value in batch.items():
+        if isinstance(value, np.ndarray):
+            batch[key] = torch.from_numpy(value)
+    return batch
\ No newline at end of file
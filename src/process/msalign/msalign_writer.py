@@ -1,7 +1,17 @@
+from process.msalign import peak_format
+
+
 class MsalignWriter():
-    def __init__(self, msalign_file): 
+    def __init__(self, msalign_file, binary=False, append=False): 
+        # binary mode copies the peak_block of MsalignSpectrumView objects
+        # to the output without decoding it
         self.msalign_file = msalign_file
-        self.f = open(msalign_file, "w", buffering=1024*1024*1024)
+        self.binary = binary
+        mode = "a" if append else "w"
+        if binary:
+            self.f = open(msalign_file, mode + "b", buffering=1024*1024*1024)
+        else:
+            self.f = open(msalign_file, mode, buffering=1024*1024*1024)
     
     def __del__(self):
         self.f.close()
@@ -10,29 +20,37 @@ class MsalignWriter():
         self.f.close()
 
     def write(self, spectrum):
-        self.f.write("BEGIN IONS\n")
-        for line in spectrum["meta_lines"]:
-            self.f.write(line + "\n")
-        for line in spectrum["peak_lines"]:
-            self.f.write(line + "\n")
-        self.f.write("END IONS\n\n")
+        if self.binary:
+            self.write_binary(spectrum)
+            return
+        # one write per spectrum
+        lines = ["BEGIN IONS", *spectrum["meta_lines"], *spectrum["peak_lines"]]
+        self.f.write("\n".join(lines) + "\nEND IONS\n\n")
+
+    def write_binary(self, spectrum):
+        header = "BEGIN IONS\n" + "".join(line + "\n" for line in spectrum["meta_lines"])
+        self.f.write(header.encode("utf-8"))
+        peak_block = spectrum.get("peak_block")
+        if peak_block is not None:
+            self.f.write(peak_block)
+        else:
+            self.f.write("".join(line + "\n" for line in spectrum["peak_lines"]).encode("utf-8"))
+        self.f.write(b"END IONS\n\n")
+
+    def write_text(self, text):
+        if self.binary:
+            self.f.write(text.encode("utf-8"))
+        else:
+            self.f.write(text)
 
     def write_using_meta(self, spectrum):
-        self.f.write("BEGIN IONS\n")
+        self.write_text("BEGIN IONS\n")
         for key in spectrum["meta"]:
-            self.f.write(key + "=" + spectrum["meta"][key] + "\n")
+            self.write_text(key + "=" + spectrum["meta"][key] + "\n")
         for line in spectrum["peak_lines"]:
-            self.f.write(line + "\n")
-        self.f.write("END IONS\n\n")
+            self.write_text(line + "\n")
+        self.write_text("END IONS\n\n")
     def write_mz_intensity(self, spectrum):
-        self.f.write("BEGIN IONS\n")
-        for line in spectrum["meta_lines"]:
-            self.f.write(line + "\n")
-        for line in spectrum["peak_lines"]:
-            fields = line.strip().split()
-            mass = float(fields[0])
-            charge = int(fields[2])
-            mz = mass / charge + 1.007276466879
-            # format mz with 5 fractional positions
-            self.f.write(f"{mz:.5f}\t{fields[1]}\t{fields[2]}\t{fields[3]}\n")
-        self.f.write("END IONS\n\n")
\ No newline at end of file
+        # peak masses are converted to m/z with 5 fractional positions
+        header = "BEGIN IONS\n" + "".join(line + "\n" for line in spectrum["meta_lines"])
+        self.write_text(header + peak_format.format_msalign_mz_block(spectrum["peak_lines"]) + "END IONS\n\n")
\ No newline at end of file
@@ -0,0 +1,50 @@
+# Peak blocks of a spectrum are formatted with one %-format of the repeated
+# peak template over all values, which gives the same text as formatting
+# each peak with an f-string and the same format spec.
+MZ_INTENSITY_FORMAT = "%.5f %.2f\n"
+MSALIGN_MZ_FORMAT = "%.5f\t%s\t%s\t%s\n"
+
+
+def as_list(values):
+    # numpy arrays are converted to lists of Python numbers
+    if hasattr(values, "tolist"):
+        return values.tolist()
+    return list(values)
+
+
+def format_peak_block(template, columns):
+    """
+    Return the text of the peaks of a spectrum: template is the format of
+    one peak line and columns the sequences of values of its fields.
+    """
+    columns = [as_list(column) for column in columns]
+    num_peaks = len(columns[0])
+    if num_peaks == 0:
+        return ""
+    num_fields = len(columns)
+    values = [None] * (num_peaks * num_fields)
+    for k, column in enumerate(columns):
+        values[k::num_fields] = column
+    return (template * num_peaks) % tuple(values)
+
+
+def format_peak_rows(templates, values):
+    """Return the text of peak lines with one template per line and the flat values of all lines."""
+    if not templates:
+        return ""
+    return "".join(templates) % tuple(values)
+
+
+def format_mz_intensity_block(mz_array, intensity_array):
+    """Peak lines "<m/z:.5f> <intensity:.2f>" of MGF files."""
+    return format_peak_block(MZ_INTENSITY_FORMAT, [mz_array, intensity_array])
+
+
+def format_msalign_mz_block(peak_lines, proton_mass=1.007276466879):
+    """
+    Convert msalign peak lines "mass intensity charge ..." into lines of
+    "<m/z:.5f>\tintensity\tcharge\t<fourth field>".
+    """
+    fields = [line.split() for line in peak_lines]
+    mzs = [float(f[0]) / int(f[2]) + proton_mass for f in fields]
+    return format_peak_block(MSALIGN_MZ_FORMAT, [mzs, [f[1] for f in fields], [f[2] for f in fields], [f[3] for f in fields]])
\ No newline at end of file
@@ -0,0 +1,604 @@
+import os
+import json
+import argparse
+import numpy as np
+from process.msalign import peak_format
+from process.msalign import msalign_writer
+
+LIBRARY_VERSION = 2
+LIBRARY_HEADER = "library.json"
+LIBRARY_SUFFIX = ".speclib"
+
+# typed fields at the beginning of the peak lines, followed by the
+# annotation fields of annotated peaks. The rest of a line is its label.
+# "float" fields keep their number of fractional digits so that the text is
+# written back unchanged.
+PEAK_FIELDS = {
+    "msalign": [("mass", "float"), ("intensity", "float"), ("charge", "int"), ("score", "float")],
+    "mgf": [("mz", "float"), ("intensity", "float")]
+}
+# fields of msalign_anno.match_observed_to_theo, also at the end of the
+# annotated mgf peaks of mgf_anno_util.format_peak_block
+FRAGMENT_FIELDS = [("ion", "str"), ("aa_num", "int"), ("pos", "int"), ("shift", "int"), ("delta_da", "float"),
+                   ("delta_ppm", "float")]
+ANNOTATION_FIELDS = {
+    "msalign": FRAGMENT_FIELDS,
+    "mgf": [("ms2_id", "int"), ("theo_mass", "float"), ("charge", "int"), ("theo_mz", "float"), ("flag", "str"),
+            ("isotope", "int"), ("theo_intensity", "float"), ("intensity_percent", "float")] + FRAGMENT_FIELDS
+}
+PEAK_SEPARATORS = {"msalign": "\t", "mgf": " "}
+
+# meta keys of the filter columns, in order of preference
+FILTER_FIELDS = {
+    "msalign": {
+        "dataset_id": ["DATASET_ID"],
+        "file_name": ["MSALIGN_FILE_NAME", "FILE_NAME"],
+        "scan": ["MS2_SCAN", "SCANS"],
+        "evalue": ["E_VALUE"],
+        "precursor_mass": ["PRECURSOR_MONOISOTOPIC_MASS", "PRECURSOR_MASS"]
+    },
+    "mgf": {
+        "dataset_id": ["DATASET_ID"],
+        "file_name": ["MZML_FILE_NAME"],
+        "scan": ["SCAN", "SCANS"],
+        "evalue": ["E_VALUE"],
+        "precursor_mass": ["PRECURSOR_MONOISOTOPIC_MASS", "PRECURSOR_MASS"]
+    }
+}
+
+FIELD_DTYPES = {"float": "<f8", "int": "<i4", "str": "<i4"}
+FIELD_FORMATS = {"float": "%.*f", "int": "%d", "str": "%s"}
+SPECTRUM_COLUMNS = {
+    "peak_offsets": "<i8",
+    "annotation_offsets": "<i8",
+    "meta_offsets": "<i8",
+    "dataset_code": "<i4",
+    "file_code": "<i4",
+    "scan": "<i8",
+    "evalue": "<f8",
+    "precursor_mass": "<f8"
+}
+META_COLUMNS = {"meta_key": "<i4", "meta_value_offsets": "<i8", "meta_value": "u1"}
+# "u1" columns are utf-8 bytes, the strings are cut by their offsets columns
+OFFSET_COLUMNS = ["peak_offsets", "annotation_offsets", "meta_offsets", "meta_value_offsets"]
+
+
+def guess_file_format(spectrum_file):
+    if spectrum_file.lower().endswith(".mgf"):
+        return "mgf"
+    return "msalign"
+
+
+def field_columns(fields):
+    columns = {}
+    for name, kind in fields:
+        columns[name] = FIELD_DTYPES[kind]
+        if kind == "float":
+            columns[name + "_decimals"] = "<i1"
+    return columns
+
+
+def dictionary_names(file_format):
+    names = ["meta_keys", "dataset_ids", "file_names", "label"]
+    for name, kind in PEAK_FIELDS[file_format] + ANNOTATION_FIELDS[file_format]:
+        if kind == "str":
+            names.append(name)
+    return names
+
+
+def library_columns(file_format):
+    # the values of dictionary <name> are strings of <name>_value, like meta_value
+    dictionary_columns = {}
+    for name in dictionary_names(file_format):
+        dictionary_columns[name + "_value_offsets"] = "<i8"
+        dictionary_columns[name + "_value"] = "u1"
+    return {
+        "spectrum": SPECTRUM_COLUMNS,
+        "meta": META_COLUMNS,
+        "peak": {"num_fields": "<i1", "label": "<i4", **field_columns(PEAK_FIELDS[file_format])},
+        "annotation": field_columns(ANNOTATION_FIELDS[file_format]),
+        "dictionary": dictionary_columns
+    }
+
+
+def parse_float(token):
+    # return (value, decimals) or None if the token is not written back
+    # unchanged by "%.*f"
+    try:
+        value = float(token)
+    except ValueError:
+        return None
+    point = token.find(".")
+    decimals = len(token) - point - 1 if point >= 0 else 0
+    if "%.*f" % (decimals, value) != token:
+        return None
+    return value, decimals
+
+
+def parse_int(token):
+    try:
+        value = int(token)
+    except ValueError:
+        return None
+    if "%d" % value != token:
+        return None
+    return value
+
+
+def iter_text_spectra(spectrum_file):
+    """
+    Yield the spectra of a msalign or mgf file as dicts with meta_lines and
+    peak_lines. Unlike readmsalign_iter, peak lines are only stripped of the
+    line break so that trailing separators are kept.
+    """
+    current = None
+    with open(spectrum_file, "r", buffering=1024*1024*64) as f:
+        for line in f:
+            stripped = line.strip()
+            if not stripped:
+                continue
+            if stripped.startswith("BEGIN IONS"):
+                current = {"meta_lines": [], "peak_lines": []}
+            elif stripped.startswith("END IONS"):
+                if current is not None:
+                    yield current
+                    current = None
+            elif current is not None:
+                if "=" in stripped:
+                    current["meta_lines"].append(stripped)
+                else:
+                    current["peak_lines"].append(line.rstrip("\r\n"))
+
+
+class Dictionary():
+    # dictionary encoding of strings, codes are given in order of appearance.
+    # new_values are the values not written to the library yet.
+    def __init__(self):
+        self.codes = {}
+        self.new_values = []
+
+    def __len__(self):
+        return len(self.codes)
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.codes)
+            self.codes[value] = code
+            self.new_values.append(value)
+        return code
+
+
+class DictionaryColumn():
+    """
+    Values of a dictionary written by SpectralLibraryWriter, read from its
+    memory-mapped <name>_value_offsets and <name>_value columns. Decoded
+    values are cached.
+    """
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, code):
+        # missing values (code -1) are empty strings
+        if code < 0:
+            return ""
+        value = self.cache.get(code)
+        if value is None:
+            value = self.data[int(self.offsets[code]):int(self.offsets[code + 1])].tobytes().decode("utf-8")
+            self.cache[code] = value
+        return value
+
+    def code(self, value):
+        """Return the code of value, or -2 if value is not in the dictionary."""
+        encoded = value.encode("utf-8")
+        lengths = np.diff(self.offsets)
+        for code in np.flatnonzero(lengths == len(encoded)).tolist():
+            if self.data[int(self.offsets[code]):int(self.offsets[code + 1])].tobytes() == encoded:
+                return code
+        return -2
+
+
+class SpectralLibraryWriter():
+    """
+    Writer of a binary spectral library: a directory with one raw
+    little-endian array file per column (<column>.bin) and a small header
+    (library.json) with the dtypes, the sizes and the fields.
+
+    Spectra are rows of the spectrum columns: the filter columns
+    (dataset_code, file_code, scan, evalue, precursor_mass) and the offsets
+    of their meta lines, peaks and annotations. Meta lines are stored as
+    dictionary encoded keys and utf-8 values. Peaks are list columns: the
+    peaks of spectrum i are rows peak_offsets[i]:peak_offsets[i+1] of the
+    peak columns, and the annotation fields of its annotated peaks (peaks
+    with more than the PEAK_FIELDS) are rows
+    annotation_offsets[i]:annotation_offsets[i+1] of the annotation columns.
+    Peak labels and "str" fields are dictionary encoded. The values of each
+    dictionary are stored in columns like the meta values and are written
+    when they first appear, so only the codes are kept in memory.
+
+    write(spectrum) takes the dicts of MsalignReader.readmsalign_iter, the
+    same as MsalignWriter.write.
+    """
+    def __init__(self, library_dir, file_format="msalign", flush_size=10000):
+        if file_format not in PEAK_FIELDS:
+            raise ValueError(f"Invalid file format: {file_format}. Choose 'msalign' or 'mgf'.")
+        self.library_dir = library_dir
+        self.file_format = file_format
+        self.flush_size = flush_size
+        self.peak_fields = PEAK_FIELDS[file_format]
+        self.annotation_fields = ANNOTATION_FIELDS[file_format]
+        self.separator = PEAK_SEPARATORS[file_format]
+        self.filter_fields = FILTER_FIELDS[file_format]
+        self.column_groups = library_columns(file_format)
+        self.columns = {}
+        for columns in self.column_groups.values():
+            self.columns.update(columns)
+        self.dictionaries = {name: Dictionary() for name in dictionary_names(file_format)}
+        self.dictionary_sizes = {name: 0 for name in self.dictionaries}
+        os.makedirs(library_dir, exist_ok=True)
+        self.files = {name: open(os.path.join(library_dir, name + ".bin"), "wb") for name in self.columns}
+        self.num_spectra = 0
+        self.num_peaks = 0
+        self.num_annotations = 0
+        self.num_meta_lines = 0
+        self.meta_value_size = 0
+        self.buffers = {name: [] for name in self.columns}
+        # offset columns start with 0
+        for name in OFFSET_COLUMNS + [name + "_value_offsets" for name in self.dictionaries]:
+            self.buffers[name].append(0)
+        self.buffered_spectra = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def filter_values(self, meta):
+        values = {}
+        for key, names in self.filter_fields.items():
+            values[key] = next((meta[name] for name in names if name in meta), None)
+        return values
+
+    def append_fields(self, fields, parsed):
+        # parsed values of the first fields, missing fields are filled
+        buffers = self.buffers
+        for k, (name, kind) in enumerate(fields):
+            if k < len(parsed):
+                value = parsed[k]
+            elif kind == "float":
+                value = (np.nan, -1)
+            else:
+                value = -1 if kind == "str" else 0
+            if kind == "float":
+                buffers[name].append(value[0])
+                buffers[name + "_decimals"].append(value[1])
+            else:
+                buffers[name].append(value)
+
+    def add_peak(self, line):
+        fields = self.peak_fields + self.annotation_fields
+        parts = line.split(self.separator, len(fields))
+        parsed = []
+        for name, kind in fields[:len(parts)]:
+            token = parts[len(parsed)]
+            if kind == "float":
+                value = parse_float(token)
+            elif kind == "int":
+                value = parse_int(token)
+            else:
+                value = self.dictionaries[name].encode(token)
+            if value is None:
+                break
+            parsed.append(value)
+        num_fields = len(parsed)
+        self.append_fields(self.peak_fields, parsed)
+        if num_fields > len(self.peak_fields):
+            self.append_fields(self.annotation_fields, parsed[len(self.peak_fields):])
+            self.num_annotations += 1
+        self.buffers["num_fields"].append(num_fields)
+        if num_fields < len(parts):
+            self.buffers["label"].append(self.dictionaries["label"].encode(self.separator.join(parts[num_fields:])))
+        else:
+            self.buffers["label"].append(-1)
+
+    def write(self, spectrum):
+        buffers = self.buffers
+        meta = {}
+        for line in spectrum["meta_lines"]:
+            key, value = line.split("=", 1)
+            meta.setdefault(key, value)
+            buffers["meta_key"].append(self.dictionaries["meta_keys"].encode(key))
+            value = value.encode("utf-8")
+            buffers["meta_value"].append(value)
+            self.meta_value_size += len(value)
+            buffers["meta_value_offsets"].append(self.meta_value_size)
+        self.num_meta_lines += len(spectrum["meta_lines"])
+        buffers["meta_offsets"].append(self.num_meta_lines)
+
+        values = self.filter_values(meta)
+        dataset_id = values["dataset_id"]
+        file_name = values["file_name"]
+        buffers["dataset_code"].append(-1 if dataset_id is None else self.dictionaries["dataset_ids"].encode(dataset_id))
+        buffers["file_code"].append(-1 if file_name is None else
+                                    self.dictionaries["file_names"].encode(os.path.basename(file_name)))
+        scan = values["scan"]
+        buffers["scan"].append(int(scan.split()[0]) if scan and scan.split()[0].isdigit() else -1)
+        buffers["evalue"].append(parse_meta_float(values["evalue"]))
+        buffers["precursor_mass"].append(parse_meta_float(values["precursor_mass"]))
+
+        for line in spectrum["peak_lines"]:
+            self.add_peak(line)
+        self.num_peaks += len(spectrum["peak_lines"])
+        buffers["peak_offsets"].append(self.num_peaks)
+        buffers["annotation_offsets"].append(self.num_annotations)
+        self.num_spectra += 1
+        self.buffered_spectra += 1
+        if self.buffered_spectra >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        for name, dictionary in self.dictionaries.items():
+            for value in dictionary.new_values:
+                value = value.encode("utf-8")
+                self.buffers[name + "_value"].append(value)
+                self.dictionary_sizes[name] += len(value)
+                self.buffers[name + "_value_offsets"].append(self.dictionary_sizes[name])
+            dictionary.new_values.clear()
+        for name, values in self.buffers.items():
+            if not values:
+                continue
+            if self.columns[name] == "u1":
+                self.files[name].write(b"".join(values))
+            else:
+                self.files[name].write(np.array(values, dtype=self.columns[name]).tobytes())
+            values.clear()
+        self.buffered_spectra = 0
+
+    def close(self):
+        if self.files is None:
+            return
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.files = None
+        header = {
+            "version": LIBRARY_VERSION,
+            "format": self.file_format,
+            "num_spectra": self.num_spectra,
+            "num_peaks": self.num_peaks,
+            "num_annotations": self.num_annotations,
+            "num_meta_lines": self.num_meta_lines,
+            "peak_fields": self.peak_fields,
+            "annotation_fields": self.annotation_fields,
+            "separator": self.separator,
+            "columns": self.column_groups,
+            "dictionaries": {name: len(d) for name, d in self.dictionaries.items()}
+        }
+        tmp_file = os.path.join(self.library_dir, LIBRARY_HEADER + ".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(header, f)
+        os.replace(tmp_file, os.path.join(self.library_dir, LIBRARY_HEADER))
+
+
+def parse_meta_float(value):
+    # first value of "mass1:mass2" lists, nan if missing or empty
+    if not value:
+        return np.nan
+    try:
+        return float(value.split(":")[0])
+    except ValueError:
+        return np.nan
+
+
+def is_library(path):
+    return os.path.isfile(os.path.join(path, LIBRARY_HEADER))
+
+
+class SpectralLibrary():
+    """
+    Reader of a library written by SpectralLibraryWriter. The column files,
+    including the dictionary values, are memory-mapped when they are first
+    used, so select() reads only the filter columns and spectrum(i) only the
+    rows of spectrum i.
+
+    Usage:
+        library = SpectralLibrary("spectra_anno_ms2.speclib")
+        for i in library.select(dataset_id="PXD029703", max_evalue=0.01, min_mass=5000):
+            spectrum = library.spectrum(i)
+    """
+    def __init__(self, library_dir):
+        self.library_dir = library_dir
+        with open(os.path.join(library_dir, LIBRARY_HEADER), "r") as f:
+            header = json.load(f)
+        if header["version"] != LIBRARY_VERSION:
+            raise ValueError(f"Unsupported library version {header['version']} in {library_dir}")
+        self.file_format = header["format"]
+        self.num_spectra = header["num_spectra"]
+        self.peak_fields = [tuple(field) for field in header["peak_fields"]]
+        self.annotation_fields = [tuple(field) for field in header["annotation_fields"]]
+        self.separator = header["separator"]
+        self.column_groups = header["columns"]
+        self.dictionary_sizes = header["dictionaries"]
+        self.dictionaries = {}
+        self.columns = {}
+
+    def __len__(self):
+        return self.num_spectra
+
+    def column(self, name):
+        if name not in self.columns:
+            dtype = next(np.dtype(columns[name]) for columns in self.column_groups.values() if name in columns)
+            filename = os.path.join(self.library_dir, name + ".bin")
+            if os.path.getsize(filename) == 0:
+                self.columns[name] = np.zeros(0, dtype=dtype)
+            else:
+                self.columns[name] = np.memmap(filename, dtype=dtype, mode="r")
+        return self.columns[name]
+
+    def dictionary(self, name):
+        if name not in self.dictionaries:
+            self.dictionaries[name] = DictionaryColumn(self.column(name + "_value_offsets"), self.column(name + "_value"))
+        return self.dictionaries[name]
+
+    def select(self, dataset_id=None, file_name=None, scan=None, max_evalue=None, min_mass=None, max_mass=None):
+        """
+        Return the numbers of the spectra matching all given filters, in
+        library order. scan is a scan number or a list of scan numbers,
+        spectra without an E-value do not match max_evalue.
+        """
+        mask = np.ones(self.num_spectra, dtype=bool)
+        for name, dictionary, value in [("dataset_code", "dataset_ids", dataset_id),
+                                        ("file_code", "file_names", file_name)]:
+            if value is None:
+                continue
+            mask &= self.column(name) == self.dictionary(dictionary).code(value)
+        if scan is not None:
+            mask &= np.isin(self.column("scan"), np.atleast_1d(np.asarray(scan, dtype=np.int64)))
+        # comparisons with nan are False
+        if max_evalue is not None:
+            mask &= self.column("evalue") <= max_evalue
+        if min_mass is not None:
+            mask &= self.column("precursor_mass") >= min_mass
+        if max_mass is not None:
+            mask &= self.column("precursor_mass") <= max_mass
+        return np.flatnonzero(mask)
+
+    def meta_lines(self, i):
+        meta_offsets = self.column("meta_offsets")
+        begin = int(meta_offsets[i])
+        end = int(meta_offsets[i + 1])
+        if begin == end:
+            return []
+        keys = self.dictionary("meta_keys")
+        value_offsets = self.column("meta_value_offsets")[begin:end + 1].tolist()
+        blob = self.column("meta_value")[value_offsets[0]:value_offsets[-1]].tobytes()
+        base = value_offsets[0]
+        return [keys[code] + "=" + blob[value_offsets[k] - base:value_offsets[k + 1] - base].decode("utf-8")
+                for k, code in enumerate(self.column("meta_key")[begin:end].tolist())]
+
+    def group_rows(self, group, offsets_name, i):
+        offsets = self.column(offsets_name)
+        rows = slice(int(offsets[i]), int(offsets[i + 1]))
+        return {name: self.column(name)[rows] for name in self.column_groups[group]}
+
+    def peaks(self, i):
+        """
+        Return the peak columns of spectrum i (views of the memory-mapped
+        arrays), with the annotation columns of its annotated peaks.
+        """
+        peaks = self.group_rows("peak", "peak_offsets", i)
+        peaks.update(self.group_rows("annotation", "annotation_offsets", i))
+        return peaks
+
+    def field_values(self, peaks, fields):
+        # format arguments of each field, a list of tuples per field
+        columns = []
+        for name, kind in fields:
+            if kind == "float":
+                columns.append(list(zip(peaks[name + "_decimals"].tolist(), peaks[name].tolist())))
+            elif kind == "str":
+                values = self.dictionary(name)
+                columns.append([(values[code],) for code in peaks[name].tolist()])
+            else:
+                columns.append([(value,) for value in peaks[name].tolist()])
+        return columns
+
+    def peak_block(self, i):
+        """Return the text of the peak lines of spectrum i."""
+        peaks = self.peaks(i)
+        num_fields = peaks["num_fields"].tolist()
+        if not num_fields:
+            return ""
+        fields = self.peak_fields + self.annotation_fields
+        field_formats = [FIELD_FORMATS[kind] for name, kind in fields]
+        peak_columns = self.field_values(peaks, self.peak_fields)
+        annotation_columns = self.field_values(peaks, self.annotation_fields)
+        num_peak_fields = len(self.peak_fields)
+        labels = self.dictionary("label")
+        templates = []
+        values = []
+        annotation = 0
+        for k, (n, label) in enumerate(zip(num_fields, peaks["label"].tolist())):
+            line_formats = field_formats[:n]
+            for j in range(min(n, num_peak_fields)):
+                values += peak_columns[j][k]
+            if n > num_peak_fields:
+                for j in range(n - num_peak_fields):
+                    values += annotation_columns[j][annotation]
+                annotation += 1
+            if label >= 0:
+                line_formats = line_formats + ["%s"]
+                values.append(labels[label])
+            templates.append(self.separator.join(line_formats) + "\n")
+        return peak_format.format_peak_rows(templates, values)
+
+    def spectrum(self, i):
+        """Return spectrum i as a dict with meta, meta_lines and peak_lines, like readmsalign_iter."""
+        meta_lines = self.meta_lines(i)
+        meta = {}
+        for line in meta_lines:
+            key, value = line.split("=", 1)
+            meta[key] = value
+        peak_block = self.peak_block(i)
+        return {"meta": meta, "meta_lines": meta_lines, "peak_lines": peak_block.split("\n")[:-1]}
+
+    def iter_spectra(self, indices=None):
+        if indices is None:
+            indices = range(self.num_spectra)
+        for i in indices:
+            yield self.spectrum(int(i))
+
+
+def export_library(spectrum_file, library_dir, file_format=None):
+    """Convert a msalign or mgf file into a spectral library. Returns the number of spectra."""
+    file_format = file_format or guess_file_format(spectrum_file)
+    with SpectralLibraryWriter(library_dir, file_format) as writer:
+        for spectrum in iter_text_spectra(spectrum_file):
+            writer.write(spectrum)
+            if writer.num_spectra % 10000 == 0:
+                print(f"\rConverted {writer.num_spectra} spectra...", end='', flush=True)
+    return writer.num_spectra
+
+
+def write_spectrum_file(library_dir, output_file, indices=None):
+    """Write the spectra of a library (all or indices) to a msalign or mgf file. Returns the number of spectra."""
+    library = SpectralLibrary(library_dir)
+    writer = msalign_writer.MsalignWriter(output_file)
+    count = 0
+    for spectrum in library.iter_spectra(indices):
+        writer.write(spectrum)
+        count += 1
+    writer.close()
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert a msalign or mgf file into a binary spectral library, or a library back into a text file"
+    )
+    parser.add_argument("input", help="msalign/mgf file, or library directory (*.speclib)")
+    parser.add_argument("output", help="library directory, or msalign/mgf file if the input is a library")
+    parser.add_argument("--format", choices=["msalign", "mgf"], default=None,
+                        help="Format of the input text file (default: mgf for *.mgf, msalign otherwise)")
+    parser.add_argument("--dataset_id", default=None, help="Only write spectra of this dataset id")
+    parser.add_argument("--file_name", default=None, help="Only write spectra of this msalign (mzML for mgf) file name")
+    parser.add_argument("--scan", type=int, nargs="+", default=None, help="Only write spectra of these scans")
+    parser.add_argument("--max_evalue", type=float, default=None, help="Only write spectra with an E-value <= max_evalue")
+    parser.add_argument("--min_mass", type=float, default=None, help="Only write spectra with a precursor mass >= min_mass")
+    parser.add_argument("--max_mass", type=float, default=None, help="Only write spectra with a precursor mass <= max_mass")
+
+    args = parser.parse_args()
+    if is_library(args.input):
+        library = SpectralLibrary(args.input)
+        indices = library.select(args.dataset_id, args.file_name, args.scan, args.max_evalue, args.min_mass, args.max_mass)
+        count = write_spectrum_file(args.input, args.output, indices)
+        print(f"Wrote {count} of {len(library)} spectra to {args.output}")
+    else:
+        count = export_library(args.input, args.output, args.format)
+        print(f"\nConverted {count} spectra from {args.input} to {args.output}")
\ No newline at end of file
@@ -2,12 +2,94 @@
 import numpy as np
 import argparse
 import time
+import sys
+import resource
+from array import array
 from process.msalign import msalign_reader
 from process.msalign import msalign_writer
+from process.msalign import checkpoint
+from process.msalign_anno import prsm_store
 
 
-def merge_msalign_prsm(input_msalign_file, input_tsv_file, output_msalign_file, input_option="raw", format="msalign"):
-    is_msalign = (format.lower() == "msalign")
+KEY_COLUMNS = ["DATASET_id", "MSALIGN_file_name", "MZML_ms2_scan"]
+
+
+class TsvOffsetIndex():
+    """
+    Compact index of a large TSV file: only a 64-bit hash of the key columns
+    and the byte offset of each row are kept in memory, sorted by hash.
+    get_fields seeks to the row of a key and splits it, so rows are only read
+    for the keys that are looked up. As with a dict, the last row of a
+    duplicated key is used.
+    """
+    def __init__(self, tsv_file, key_columns=KEY_COLUMNS):
+        self.tsv_file = tsv_file
+        self.f = open(tsv_file, "rb")
+        self.header = self.f.readline().decode("utf-8").strip().split("\t")
+        self.key_idxs = [self.header.index(c) for c in key_columns]
+        max_key_idx = max(self.key_idxs)
+        hashes = array("q")
+        offsets = array("q")
+        offset = self.f.tell()
+        count = 0
+        start_time = time.time()
+        with open(tsv_file, "rb", buffering=1024*1024*16) as input_f:
+            input_f.seek(offset)
+            for line in input_f:
+                hashes.append(hash(self.row_key(line, max_key_idx)))
+                offsets.append(offset)
+                offset += len(line)
+                count += 1
+                if count % 100000 == 0:
+                    elapsed_time = time.time() - start_time
+                    print(f"\rIndexed {count} rows. Elapsed time: {elapsed_time:.2f} seconds.", end="", flush=True)
+        hashes = np.frombuffer(hashes, dtype=np.int64)
+        offsets = np.frombuffer(offsets, dtype=np.int64)
+        order = np.argsort(hashes, kind="stable")
+        self.hashes = hashes[order]
+        self.offsets = offsets[order]
+        print(f"\nBuilt offset index with {len(self.offsets)} rows from {tsv_file}")
+
+    def row_key(self, line, max_key_idx=None):
+        if max_key_idx is None:
+            max_key_idx = max(self.key_idxs)
+        field_values = line.strip().split(b"\t", max_key_idx + 1)
+        return tuple(field_values[i] for i in self.key_idxs)
+
+    def read_row(self, offset):
+        self.f.seek(offset)
+        line = self.f.readline()
+        if line.endswith(b"\r\n"):
+            line = line[:-2] + b"\n"
+        return line
+
+    def get_fields(self, key):
+        """Return the fields of the row of key (a tuple of str), or None."""
+        key = tuple(k.encode("utf-8") for k in key)
+        h = hash(key)
+        lo = np.searchsorted(self.hashes, h, side="left")
+        hi = np.searchsorted(self.hashes, h, side="right")
+        # rows with the same hash are in file order, check them from the last
+        for i in range(hi - 1, lo - 1, -1):
+            line = self.read_row(int(self.offsets[i]))
+            if self.row_key(line) == key:
+                return line.decode("utf-8").split("\t")
+        return None
+
+    def close(self):
+        self.f.close()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return max_rss / 1024 / 1024
+    return max_rss / 1024
+
+
+def load_tsv_rows(input_tsv_file):
+    # Keep all rows of the TSV file in memory, indexed by a dict
     input_f = open(input_tsv_file, "r", buffering=1024*1024*1024)  # 1G buffer
     header = input_f.readline().strip().split("\t")
     tsv_array = []
@@ -38,9 +120,44 @@ def merge_msalign_prsm(input_msalign_file, input_tsv_file, output_msalign_file,
             elapsed_time = time.time() - start_time
             print(f"\rProcessed {count} rows. Elapsed time: {elapsed_time:.2f} seconds.", end="", flush=True)
     print(f"\nBuilt index map with {len(tsv_dict)} entries.")
+    return header, tsv_array, tsv_dict
+
+
+def merge_msalign_prsm(input_msalign_file, input_tsv_file, output_msalign_file, input_option="raw", format="msalign", use_mmap=False,
+                       join_mode="memory", store_file=None, resume=False, checkpoint_interval=1000):
+    # join_mode "memory" keeps all TSV rows in memory, "offset" keeps only a
+    # compact offset index of the rows (TsvOffsetIndex). If store_file is
+    # given, rows are read from a PrSM store created by prsm_store.py and
+    # input_tsv_file is not used.
+    # The output is written to <output_msalign_file>.part and renamed when
+    # complete. With resume, an interrupted run restarts from its last
+    # checkpoint.
+    is_msalign = (format.lower() == "msalign")
+    if store_file is not None:
+        store = prsm_store.PrsmStore(store_file)
+        header = store.header
+        get_fields = store.get_fields
+    elif join_mode == "offset":
+        tsv_index = TsvOffsetIndex(input_tsv_file)
+        header = tsv_index.header
+        get_fields = tsv_index.get_fields
+    else:
+        header, tsv_array, tsv_dict = load_tsv_rows(input_tsv_file)
+
+        def get_fields(key):
+            if key in tsv_dict:
+                return tsv_array[tsv_dict[key]].split("\t")
+            return None
+    ckpt = checkpoint.CheckpointWriter(output_msalign_file, resume=resume, interval=checkpoint_interval)
+    start_offset = ckpt.skip_input(input_msalign_file)
     ms_reader = msalign_reader.MsalignReader(input_msalign_file)
-    ms_writer = msalign_writer.MsalignWriter(output_msalign_file)
-    count = 0 
+    # with use_mmap, peak blocks are copied to the output without parsing
+    ms_writer = msalign_writer.MsalignWriter(ckpt.part_file, binary=use_mmap, append=True)
+    if use_mmap:
+        spectrum_iter = ms_reader.readmsalign_mmap_iter(start_offset)
+    else:
+        spectrum_iter = ms_reader.readmsalign_iter(start_offset)
+    count = ckpt.input_count
     output_count = 0
     proteoform_idx = header.index("TOPPIC_proteoform")
     database_seq_idx = header.index("TOPPIC_database_sequence")
@@ -51,13 +168,12 @@ def merge_msalign_prsm(input_msalign_file, input_tsv_file, output_msalign_file,
     e_value_idx = header.index("TOPPIC_e-value")
     instrument_idx = header.index("MZML_instrument")
     protein_accession_idx = header.index("TOPPIC_protein_accession")
-    for spectrum in ms_reader.readmsalign_iter():
+    for spectrum in spectrum_iter:
         key = (spectrum["meta"].get("DATASET_ID", ""),
                spectrum["meta"].get("MSALIGN_FILE_NAME", ""),
                spectrum["meta"].get("MS2_SCAN", ""))
-        if key in tsv_dict:
-            tsv_idx = tsv_dict[key]
-            fields = tsv_array[tsv_idx].split("\t")
+        fields = get_fields(key)
+        if fields is not None:
             field_length = len(fields)
             collision_energy = fields[collision_energy_idx]
             #print (f"\nAnnotating spectrum with key {key}. Field length: {field_length}.")  # Debug print 
@@ -88,23 +204,49 @@ def merge_msalign_prsm(input_msalign_file, input_tsv_file, output_msalign_file,
         else:
             print(f"\nWarning: No matching entry found in TSV for spectrum with key {key}. Skipping annotation.")
         count += 1
+        ckpt.update(ms_writer.f, count, checkpoint.spectrum_key(spectrum["meta"]))
         if count % 1000 == 0:
             print(f"\rProcessed {count} spectra. Filtered {output_count} spectra.", end="", flush=True)
+    ms_writer.close()
+    ckpt.finish()
     print(f"\nFinished processing {count} spectra. Wrote {output_count} spectra to {output_msalign_file}.")
+    if store_file is not None:
+        store.close()
+    elif join_mode == "offset":
+        tsv_index.close()
+    print(f"Peak RSS: {peak_rss_mb():.2f} MB")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Annotate MS2 spectra using provided tsv and msalign files.")
     parser.add_argument(
-        "--tsv", required=True, type=str, help="Input tsv filename")
+        "--tsv", required=False, type=str, help="Input tsv filename")
     parser.add_argument(
         "--msalign", required=True, type=str, help="Input msalign filename")
     parser.add_argument(
         "--out", type=str, default=None,
         help="Output annotated msalign filename (default: ms2_spectra_annot.msalign)")
+    parser.add_argument(
+        "--mmap", action="store_true",
+        help="Memory-map the msalign file and copy peak lines to the output without parsing them")
+    parser.add_argument(
+        "--store", type=str, default=None,
+        help="PrSM store created by prsm_store.py, used instead of --tsv")
+    parser.add_argument(
+        "--join", type=str, choices=["memory", "offset"], default="memory",
+        help="TSV join mode: keep all rows in memory, or keep only row offsets and read matched rows (default: memory)")
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="Resume an interrupted run from the checkpoint of the output file")
+    parser.add_argument(
+        "--checkpoint_interval", type=int, default=1000,
+        help="Number of input spectra between checkpoints (default: 1000)")
 
     
     args = parser.parse_args()
+    if args.tsv is None and args.store is None:
+        parser.error("one of --tsv or --store is required")
     output_filename = args.out or "ms2_spectra_annot.msalign"
-    merge_msalign_prsm(args.msalign, args.tsv, output_filename)    
\ No newline at end of file
+    merge_msalign_prsm(args.msalign, args.tsv, output_filename, use_mmap=args.mmap, join_mode=args.join,
+                       store_file=args.store, resume=args.resume, checkpoint_interval=args.checkpoint_interval)    
\ No newline at end of file
@@ -1,8 +1,11 @@
 import numpy as np
 import time
 import argparse
+from collections import OrderedDict, deque
+from multiprocessing import Pool
 from process.msalign import msalign_reader
 from process.msalign import msalign_writer
+from process.msalign import checkpoint
 
 H_MASS = 1.00782503223
 ISOTOPIC_MASS = 1.00235
@@ -114,7 +117,50 @@ def match_observed_to_theo(exp_mass_table, theo_mass_table, seq, ppm_tol=20.0):
     covered_bonds = sum(1 for c in coverage if c)
     return anno_peak_lines, covered_bonds
 
-def build_mass_table(clean_seq, selected_ions, n_term_acetyl=False, fixed_mod_list=[], unexpected_mod_list=[]):
+# ---------- MATCH OBSERVED TO THEORETICAL (NUMPY) ----------
+def comp_exp_theo_indexes(exp_masses, theo_masses):
+    # nearest theoretical mass for each experimental mass, both sorted in
+    # increasing order. Ties go to the larger theoretical mass, which is the
+    # same choice made by comp_exp_mass_errors
+    if len(theo_masses) == 0:
+        return np.full(len(exp_masses), -1, dtype=np.int64)
+    right = np.searchsorted(theo_masses, exp_masses, side='left')
+    right = np.minimum(right, len(theo_masses) - 1)
+    left = np.maximum(right - 1, 0)
+    right_dist = np.abs(exp_masses - theo_masses[right])
+    left_dist = np.abs(exp_masses - theo_masses[left])
+    return np.where(right_dist <= left_dist, right, left)
+
+def match_observed_to_theo_vectorized(exp_mass_table, theo_mass_array, ion_names, seq, ppm_tol=20.0):
+    # Same output as match_observed_to_theo, but the matching and the
+    # coverage computation are done on numpy arrays. theo_mass_array and
+    # ion_names are generated by build_mass_array
+    exp_mass = np.array([e['mass'] for e in exp_mass_table], dtype=np.float64)
+    theo_mass = theo_mass_array['mass']
+    anno_peak_lines = [e['line'] for e in exp_mass_table]
+    if len(exp_mass) == 0 or len(theo_mass) == 0:
+        return anno_peak_lines, 0
+    theo_indexes = comp_exp_theo_indexes(exp_mass, theo_mass)
+    theo_m = theo_mass[theo_indexes]
+    delta_da = exp_mass - theo_m
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta_ppm = (delta_da / theo_m) * 1e6
+    is_matched = (np.abs(delta_ppm) <= ppm_tol) | (np.abs(delta_da) <= 0.01)
+    matched_exp = np.flatnonzero(is_matched)
+    for i in matched_exp:
+        ion_code, aa_num, pos, shift = theo_mass_array[['ion_code', 'aa_num', 'pos', 'shift']][theo_indexes[i]].item()
+        anno_peak_lines[i] = exp_mass_table[i]['line'].strip() + "\t" \
+                             f"{theo_ion_label(ion_names[ion_code], aa_num, shift)}" + "\t" \
+                             f"{aa_num}" + "\t" \
+                             f"{pos}" + "\t" \
+                             f"{shift}" + "\t" \
+                             f"{delta_da[i]:.4f}" + "\t" \
+                             f"{delta_ppm[i]:.2f}"
+    # compute sequence coverage
+    covered_bonds = len(np.unique(theo_mass_array['pos'][theo_indexes[matched_exp]]))
+    return anno_peak_lines, covered_bonds
+
+def build_residue_mass_list(clean_seq, n_term_acetyl=False, fixed_mod_list=[], unexpected_mod_list=[]):
     n = len(clean_seq)
     # Prepare list of fixed PTMs per position
     fixed_mod_mass_list = [0.0] * n
@@ -148,7 +194,12 @@ def build_mass_table(clean_seq, selected_ions, n_term_acetyl=False, fixed_mod_li
     # N-terminal acetylation
     if n_term_acetyl:
         residue_mass_list[0] += ACETYL_MASS 
+    return residue_mass_list
 
+def build_mass_table(clean_seq, selected_ions, n_term_acetyl=False, fixed_mod_list=[], unexpected_mod_list=[]):
+    n = len(clean_seq)
+    residue_mass_list = build_residue_mass_list(clean_seq, n_term_acetyl=n_term_acetyl, fixed_mod_list=fixed_mod_list,
+                                                unexpected_mod_list=unexpected_mod_list)
     # Compute prefix and suffix masses 
     prefix_mass_list = [0.0] * n
     prefix_sum = 0.0
@@ -189,6 +240,56 @@ def build_mass_table(clean_seq, selected_ions, n_term_acetyl=False, fixed_mod_li
     mass_table.sort(key=lambda x: x['mass'])
     return mass_table
 
+# compact version of the theoretical mass table: one record per fragment mass,
+# ion labels are rendered by theo_ion_label only for matched fragments
+THEO_MASS_DTYPE = np.dtype([
+    ('mass', np.float64),
+    ('ion_code', np.int16),  # index in the ion name list
+    ('aa_num', np.int32),
+    ('pos', np.int32),
+    ('shift', np.int8)
+])
+
+ISOTOPIC_SHIFTS = np.array([0, 1, -1], dtype=np.int8)
+
+def build_mass_array(clean_seq, selected_ions, n_term_acetyl=False, fixed_mod_list=[], unexpected_mod_list=[]):
+    # Same fragments and the same order as build_mass_table. Returns a
+    # THEO_MASS_DTYPE array sorted by mass and the list of ion names.
+    residue_mass_list = build_residue_mass_list(clean_seq, n_term_acetyl=n_term_acetyl, fixed_mod_list=fixed_mod_list,
+                                                unexpected_mod_list=unexpected_mod_list)
+    ion_names = list(selected_ions)
+    n = len(residue_mass_list)
+    if n < 2 or len(ion_names) == 0:
+        return np.zeros(0, dtype=THEO_MASS_DTYPE), ion_names
+    residue_masses = np.array(residue_mass_list, dtype=np.float64)
+    # prefix_masses[k] and suffix_masses[k] are the masses of the fragments
+    # with k + 1 amino acids
+    prefix_masses = np.cumsum(residue_masses)[:-1]
+    suffix_masses = np.cumsum(residue_masses[::-1])[:-1]
+    ion_shifts = np.array([selected_ions[ion] for ion in ion_names], dtype=np.float64)
+    is_n_term = np.array([ion[0] in ['a', 'b', 'c'] for ion in ion_names])
+    # shape: ion type x cleavage site x isotopic shift
+    neutral_masses = np.where(is_n_term[:, None], prefix_masses, suffix_masses) + ion_shifts[:, None]
+    masses = np.stack([neutral_masses, neutral_masses + ISOTOPIC_MASS, neutral_masses - ISOTOPIC_MASS], axis=2)
+    aa_nums = np.arange(1, n, dtype=np.int32)
+    positions = np.where(is_n_term[:, None], aa_nums, n - aa_nums)
+
+    shape = masses.shape
+    mass_array = np.empty(masses.size, dtype=THEO_MASS_DTYPE)
+    mass_array['mass'] = masses.ravel()
+    mass_array['ion_code'] = np.broadcast_to(np.arange(len(ion_names))[:, None, None], shape).ravel()
+    mass_array['aa_num'] = np.broadcast_to(aa_nums[None, :, None], shape).ravel()
+    mass_array['pos'] = np.broadcast_to(positions[:, :, None], shape).ravel()
+    mass_array['shift'] = np.broadcast_to(ISOTOPIC_SHIFTS, shape).ravel()
+    # stable sort keeps the tie order of build_mass_table
+    order = np.argsort(mass_array['mass'], kind='stable')
+    return mass_array[order], ion_names
+
+def theo_ion_label(ion_name, aa_num, shift):
+    if shift == 0:
+        return f"{ion_name}{aa_num}"
+    return f"{ion_name}{aa_num}{shift:+d}"
+
 def parse_proteoform(spectrum_meta): 
     proteoform_str = spectrum_meta.get("PROTEOFORM")
     n_term_acetyl = proteoform_str.startswith('[Acetyl]-')
@@ -231,7 +332,75 @@ def parse_proteoform(spectrum_meta):
     return n_term_acetyl, fixed_mod_list, unexpected_mod_list
         
 
-def annot_one_spectrum(spectrum, activation_ions=None, ppm_tol=20.0):
+# approximate memory used by one dict in the table from build_mass_table
+MASS_TABLE_ENTRY_BYTES = 480
+
+class TheoMassTableCache():
+    """
+    LRU cache of theoretical mass tables. Many PrSMs share the same
+    proteoform, so the key is built from the database sequence, N-terminal
+    acetylation, fixed PTMs, unexpected modifications and the selected ions.
+    Tables are evicted when their total size exceeds max_mb.
+    """
+    def __init__(self, max_mb=256):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.tables = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, build_func):
+        if key in self.tables:
+            self.tables.move_to_end(key)
+            self.hits += 1
+            return self.tables[key][0]
+        self.misses += 1
+        table = build_func()
+        table_bytes = self.table_nbytes(table)
+        if table_bytes > self.max_bytes:
+            return table
+        self.tables[key] = (table, table_bytes)
+        self.total_bytes += table_bytes
+        while self.total_bytes > self.max_bytes:
+            _, (_, evicted_bytes) = self.tables.popitem(last=False)
+            self.total_bytes -= evicted_bytes
+            self.evictions += 1
+        return table
+
+    @staticmethod
+    def table_nbytes(table):
+        if isinstance(table, tuple):
+            # (theo_mass_array, ion_names) from build_mass_array
+            return table[0].nbytes
+        return len(table) * MASS_TABLE_ENTRY_BYTES
+
+    def print_summary(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups > 0 else 0.0
+        print(f"Mass table cache: {self.hits} hits, {self.misses} misses ({hit_rate:.2f}% hit rate), "
+              f"{self.evictions} evictions, {len(self.tables)} tables ({self.total_bytes / 1024 / 1024:.2f} MB) cached.")
+
+def build_theo_table(seq, selected_ions, spectrum_meta, vectorized=False):
+    n_term_acetyl, fixed_mod_list, unexpected_mod_list = parse_proteoform(spectrum_meta)
+    if vectorized:
+        return build_mass_array(seq, selected_ions=selected_ions,
+                                n_term_acetyl=n_term_acetyl, fixed_mod_list=fixed_mod_list,
+                                unexpected_mod_list=unexpected_mod_list)
+    return build_mass_table(seq, selected_ions = selected_ions, 
+                            n_term_acetyl=n_term_acetyl, fixed_mod_list=fixed_mod_list, 
+                            unexpected_mod_list=unexpected_mod_list) 
+
+def theo_table_cache_key(seq, selected_ions, spectrum_meta, vectorized=False):
+    proteoform_str = spectrum_meta.get("PROTEOFORM") or ""
+    return (seq, 
+            proteoform_str.startswith('[Acetyl]-'),
+            spectrum_meta.get("FIXED_PTMS"),
+            spectrum_meta.get("UNEXPECTED_MODIFICATIONS"),
+            tuple(selected_ions.items()),
+            vectorized)
+
+def annot_one_spectrum(spectrum, activation_ions=None, ppm_tol=20.0, vectorized=False, mass_table_cache=None):
     seq = spectrum["meta"].get("DATABASE_SEQUENCE", None)
     if seq in (None, ""):
         spectrum["meta_lines"].append("SEQUENCE_COVERAGE=")
@@ -253,28 +422,135 @@ def annot_one_spectrum(spectrum, activation_ions=None, ppm_tol=20.0):
         print(f"Warning: No ion types selected for activation method '{activation}'. No annotation will be performed.")
         print(f"Available activation methods: {list(activation_ions.keys())}")
         return spectrum
-    n_term_acetyl, fixed_mod_list, unexpected_mod_list = parse_proteoform(spectrum["meta"])
-    theo_mass_table = build_mass_table(seq, selected_ions = selected_ions, 
-                                       n_term_acetyl=n_term_acetyl, fixed_mod_list=fixed_mod_list, 
-                                       unexpected_mod_list=unexpected_mod_list) 
-    annot_peak_lines, covered_bonds = match_observed_to_theo(exp_mass_table, theo_mass_table, seq=seq, ppm_tol=ppm_tol)
+    if mass_table_cache is None:
+        theo_table = build_theo_table(seq, selected_ions, spectrum["meta"], vectorized=vectorized)
+    else:
+        key = theo_table_cache_key(seq, selected_ions, spectrum["meta"], vectorized=vectorized)
+        theo_table = mass_table_cache.get(
+            key, lambda: build_theo_table(seq, selected_ions, spectrum["meta"], vectorized=vectorized))
+    if vectorized:
+        theo_mass_array, ion_names = theo_table
+        annot_peak_lines, covered_bonds = match_observed_to_theo_vectorized(exp_mass_table, theo_mass_array, ion_names,
+                                                                            seq=seq, ppm_tol=ppm_tol)
+    else:
+        annot_peak_lines, covered_bonds = match_observed_to_theo(exp_mass_table, theo_table, seq=seq, ppm_tol=ppm_tol)
     spectrum["meta_lines"].append(f"SEQUENCE_COVERAGE={covered_bonds}")
     spectrum["peak_lines"] = annot_peak_lines
     return spectrum
 
 # ---------- WRITE ANNOTATED MSALIGN WITH MULTIPROCESSING ----------
-def annot_msalign(input_msalign, output_file, activation_ions, ppm_tol=20.0):
+# state shared by all tasks of a pool worker, set by init_annot_worker
+_WORKER_STATE = {}
+
+def init_annot_worker(activation_ions, ppm_tol, vectorized, cache_mb):
+    _WORKER_STATE["activation_ions"] = activation_ions
+    _WORKER_STATE["ppm_tol"] = ppm_tol
+    _WORKER_STATE["vectorized"] = vectorized
+    _WORKER_STATE["cache"] = TheoMassTableCache(cache_mb) if cache_mb > 0 else None
+
+def annot_spectrum_batch(spectra):
+    """
+    Worker function: annotate a batch of spectra. Returns the annotated
+    spectra and the cache hits and misses of this batch.
+    """
+    cache = _WORKER_STATE["cache"]
+    hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    annotated = [annot_one_spectrum(spectrum, activation_ions=_WORKER_STATE["activation_ions"],
+                                    ppm_tol=_WORKER_STATE["ppm_tol"], vectorized=_WORKER_STATE["vectorized"],
+                                    mass_table_cache=cache)
+                 for spectrum in spectra]
+    if cache is None:
+        return annotated, 0, 0
+    return annotated, cache.hits - hits, cache.misses - misses
+
+def iter_spectrum_batches(spectra, batch_size):
+    batch = []
+    for spectrum in spectra:
+        batch.append(spectrum)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def annot_msalign(input_msalign, output_file, activation_ions, ppm_tol=20.0, vectorized=False, cache_mb=256,
+                  num_workers=1, batch_size=200, max_inflight=None, resume=False, checkpoint_interval=1000):
+    # The output is written to <output_file>.part and renamed when complete.
+    # With resume, an interrupted run restarts from its last checkpoint.
+    if num_workers > 1:
+        return annot_msalign_parallel(input_msalign, output_file, activation_ions, ppm_tol=ppm_tol,
+                                      vectorized=vectorized, cache_mb=cache_mb, num_workers=num_workers,
+                                      batch_size=batch_size, max_inflight=max_inflight, resume=resume,
+                                      checkpoint_interval=checkpoint_interval)
+    ckpt = checkpoint.CheckpointWriter(output_file, resume=resume, interval=checkpoint_interval)
+    start_offset = ckpt.skip_input(input_msalign)
     ms_reader = msalign_reader.MsalignReader(input_msalign)
-    ms_writer = msalign_writer.MsalignWriter(output_file)
-    count = 0
+    ms_writer = msalign_writer.MsalignWriter(ckpt.part_file, append=True)
+    # cache_mb = 0 disables the mass table cache
+    mass_table_cache = TheoMassTableCache(cache_mb) if cache_mb > 0 else None
+    count = ckpt.input_count
     start_time = time.time()
-    for spectrum in ms_reader.readmsalign_iter():
-        spectrum = annot_one_spectrum(spectrum, activation_ions=activation_ions, ppm_tol=ppm_tol)
+    for spectrum in ms_reader.readmsalign_iter(start_offset):
+        spectrum = annot_one_spectrum(spectrum, activation_ions=activation_ions, ppm_tol=ppm_tol, vectorized=vectorized,
+                                      mass_table_cache=mass_table_cache)
         ms_writer.write(spectrum)
         count += 1
+        ckpt.update(ms_writer.f, count, checkpoint.spectrum_key(spectrum["meta"]))
         if count % 1000 == 0:
             elapsed_time = time.time() - start_time
             print(f"\rAnnotated {count} spectra. Elapsed time: {elapsed_time:.2f} seconds.", end="", flush=True)
+    ms_writer.close()
+    ckpt.finish()
+    print(f"\nFinished annotating {count} spectra.")
+    if mass_table_cache is not None:
+        mass_table_cache.print_summary()
+
+def annot_msalign_parallel(input_msalign, output_file, activation_ions, ppm_tol=20.0, vectorized=False, cache_mb=256,
+                           num_workers=2, batch_size=200, max_inflight=None, resume=False, checkpoint_interval=1000):
+    # Spectra are sent to the pool in batches of batch_size and written in
+    # the input order. At most max_inflight batches are read ahead of the
+    # writer, so memory does not grow with the file size.
+    max_inflight = max_inflight or 4 * num_workers
+    ckpt = checkpoint.CheckpointWriter(output_file, resume=resume, interval=checkpoint_interval)
+    start_offset = ckpt.skip_input(input_msalign)
+    ms_reader = msalign_reader.MsalignReader(input_msalign)
+    ms_writer = msalign_writer.MsalignWriter(ckpt.part_file, append=True)
+    count = ckpt.input_count
+    cache_hits = 0
+    cache_misses = 0
+    start_time = time.time()
+    print(f"Annotating spectra with {num_workers} workers...")
+    with Pool(num_workers, initializer=init_annot_worker,
+              initargs=(activation_ions, ppm_tol, vectorized, cache_mb)) as pool:
+        pending = deque()
+        batches = iter_spectrum_batches(ms_reader.readmsalign_iter(start_offset), batch_size)
+        while True:
+            while len(pending) < max_inflight:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                pending.append(pool.apply_async(annot_spectrum_batch, (batch,)))
+            if not pending:
+                break
+            annotated, hits, misses = pending.popleft().get()
+            for spectrum in annotated:
+                ms_writer.write(spectrum)
+            cache_hits += hits
+            cache_misses += misses
+            prev_count = count
+            count += len(annotated)
+            if annotated:
+                ckpt.update(ms_writer.f, count, checkpoint.spectrum_key(annotated[-1]["meta"]))
+            if count // 1000 > prev_count // 1000:
+                elapsed_time = time.time() - start_time
+                print(f"\rAnnotated {count} spectra. Elapsed time: {elapsed_time:.2f} seconds.", end="", flush=True)
+    ms_writer.close()
+    ckpt.finish()
+    print(f"\nFinished annotating {count} spectra.")
+    if cache_mb > 0:
+        lookups = cache_hits + cache_misses
+        hit_rate = cache_hits / lookups * 100 if lookups > 0 else 0.0
+        print(f"Mass table cache: {cache_hits} hits, {cache_misses} misses ({hit_rate:.2f}% hit rate) in all workers.")
 
 def get_ion_list(ion_mode, activation, include_ion_loss):
     # Selecte ion types based on activation method and ion mode
@@ -320,6 +596,26 @@ if __name__ == "__main__":
         "--ion_type", required=False, type=str, choices = ['basic', 'all'], help="Ion type (basic/all)", default='basic')
     parser.add_argument(
         "--neutral_loss", required=False, action='store_true', help="Include ion neutral losses (e.g., -H2O, -NH3)")
+    parser.add_argument(
+        "--vectorized", required=False, action='store_true', help="Match fragment masses using numpy arrays")
+    parser.add_argument(
+        "--cache_mb", required=False, type=int, default=256,
+        help="Memory cap in MB of the theoretical mass table cache, 0 to disable (default: 256)")
+    parser.add_argument(
+        "--num_workers", "-n", required=False, type=int, default=1,
+        help="Number of CPU workers (default: 1)")
+    parser.add_argument(
+        "--batch_size", required=False, type=int, default=200,
+        help="Number of spectra in each batch sent to a worker (default: 200)")
+    parser.add_argument(
+        "--max_inflight", required=False, type=int, default=None,
+        help="Maximum number of batches read ahead of the writer (default: 4 x num_workers)")
+    parser.add_argument(
+        "--resume", required=False, action='store_true',
+        help="Resume an interrupted run from the checkpoint of the output file")
+    parser.add_argument(
+        "--checkpoint_interval", required=False, type=int, default=1000,
+        help="Number of input spectra between checkpoints (default: 1000)")
 
     args = parser.parse_args()
     output_filename = args.out or "ms2_spectra_annot.msalign"
@@ -334,4 +630,6 @@ if __name__ == "__main__":
         activation_ions[activation] = selected_ions
         #print(f"Annotating spectra with activation method: {activation}")
 
-    annot_msalign(args.msalign, output_filename, activation_ions)    
\ No newline at end of file
+    annot_msalign(args.msalign, output_filename, activation_ions, vectorized=args.vectorized, cache_mb=args.cache_mb,
+                  num_workers=args.num_workers, batch_size=args.batch_size, max_inflight=args.max_inflight,
+                  resume=args.resume, checkpoint_interval=args.checkpoint_interval)    
\ No newline at end of file
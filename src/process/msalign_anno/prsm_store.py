@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+import sqlite3
+
+KEY_COLUMNS = ["DATASET_id", "MSALIGN_file_name", "MZML_ms2_scan"]
+
+
+def ingest_tsv(tsv_file, store_file, batch_size=100000):
+    """
+    Convert the comprehensive TSV file into a SQLite PrSM store partitioned by
+    (DATASET_id, MSALIGN_file_name). Each row is stored as its original TSV
+    line with the key (DATASET_id, MSALIGN_file_name, MZML_ms2_scan). The
+    partitions table is the manifest with the row count of each partition.
+    """
+    tmp_file = store_file + ".tmp"
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    conn = sqlite3.connect(tmp_file)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("CREATE TABLE prsm (dataset_id TEXT, msalign_file_name TEXT, ms2_scan TEXT, row TEXT, "
+                 "PRIMARY KEY (dataset_id, msalign_file_name, ms2_scan)) WITHOUT ROWID")
+    conn.execute("CREATE TABLE partitions (dataset_id TEXT, msalign_file_name TEXT, row_count INTEGER, "
+                 "PRIMARY KEY (dataset_id, msalign_file_name))")
+
+    input_f = open(tsv_file, "r", buffering=1024*1024*64)
+    header_line = input_f.readline()
+    header = header_line.strip().split("\t")
+    key_idxs = [header.index(c) for c in KEY_COLUMNS]
+    conn.execute("INSERT INTO meta VALUES ('header', ?)", (header_line.strip(),))
+    conn.execute("INSERT INTO meta VALUES ('source', ?)", (os.path.basename(tsv_file),))
+
+    batch = []
+    count = 0
+    start_time = time.time()
+    for line in input_f:
+        field_values = line.strip().split("\t")
+        batch.append(tuple(field_values[i] for i in key_idxs) + (line,))
+        count += 1
+        if len(batch) >= batch_size:
+            # the last row of a duplicated key is kept, as in merge_msalign_prsm
+            conn.executemany("INSERT OR REPLACE INTO prsm VALUES (?, ?, ?, ?)", batch)
+            batch = []
+            elapsed_time = time.time() - start_time
+            print(f"\rIngested {count} rows. Elapsed time: {elapsed_time:.2f} seconds.", end="", flush=True)
+    if batch:
+        conn.executemany("INSERT OR REPLACE INTO prsm VALUES (?, ?, ?, ?)", batch)
+    input_f.close()
+    conn.execute("INSERT INTO partitions SELECT dataset_id, msalign_file_name, COUNT(*) FROM prsm "
+                 "GROUP BY dataset_id, msalign_file_name")
+    conn.commit()
+    partition_count = conn.execute("SELECT COUNT(*) FROM partitions").fetchone()[0]
+    conn.close()
+    os.replace(tmp_file, store_file)
+    print(f"\nIngested {count} rows in {partition_count} partitions from {tsv_file}")
+    print(f"Saved to: {store_file}")
+
+
+class PrsmStore():
+    """
+    Read access to a store created by ingest_tsv. Only the partitions of the
+    (DATASET_id, MSALIGN_file_name) pairs that are looked up are loaded.
+    """
+    def __init__(self, store_file):
+        if not os.path.isfile(store_file):
+            raise FileNotFoundError(f"PrSM store not found: {store_file}")
+        self.conn = sqlite3.connect(f"file:{store_file}?mode=ro", uri=True)
+        header_line = self.conn.execute("SELECT value FROM meta WHERE key = 'header'").fetchone()[0]
+        self.header = header_line.split("\t")
+        self.partitions = {}
+
+    def load_partition(self, dataset_id, msalign_file_name):
+        """Return a dict {MZML_ms2_scan: TSV line} of one partition."""
+        key = (dataset_id, msalign_file_name)
+        if key not in self.partitions:
+            rows = self.conn.execute("SELECT ms2_scan, row FROM prsm WHERE dataset_id = ? AND msalign_file_name = ?",
+                                     key)
+            self.partitions[key] = dict(rows)
+            print(f"Loaded {len(self.partitions[key])} rows for {dataset_id} {msalign_file_name} from the PrSM store")
+        return self.partitions[key]
+
+    def get_fields(self, key):
+        """Return the fields of the row of (DATASET_id, MSALIGN_file_name, MZML_ms2_scan), or None."""
+        partition = self.load_partition(key[0], key[1])
+        line = partition.get(key[2])
+        if line is None:
+            return None
+        return line.split("\t")
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python script.py <input_tsv_filename> <output_store_filename>")
+        sys.exit(1)
+    ingest_tsv(sys.argv[1], sys.argv[2])
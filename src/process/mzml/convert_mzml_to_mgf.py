@@ -2,134 +2,329 @@
 this version includes ms1 peak list
 """
 from pyteomics import mzml, mgf
+from pyteomics.auxiliary.utils import BinaryDataArrayTransformer
 import os
-import sys
-# import re
+import io
+import re
+import argparse
+from collections import deque
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import unescape
 from pathlib import Path
+import numpy as np
+from process.msalign import peak_format
 
 
-def mzML_ms_extract_with_ms1(mzml_filename):
-    result = []  
+def mzML_ms_extract_with_ms1(mzml_filename, include_ms1=False):
+    # generator: the spectra are read while the caller writes them
     with mzml.MzML(mzml_filename) as reader:
-        last_ms1 = None  # last MS1 spectrum
+        yield from extract_ms2_spectra(reader, mzml_filename, include_ms1)
+
+
+def decode_spectrum_arrays(spectrum, decode=True):
+    # decode the binary arrays of a spectrum read with decode_binary=False
+    if decode:
+        for key, value in spectrum.items():
+            if isinstance(value, BinaryDataArrayTransformer.binary_array_record):
+                # an empty <binary> element is an empty array, as in pyteomics
+                spectrum[key] = value.decode() if value.data else np.array([], dtype=value.dtype)
+    return spectrum
+
+
+def iter_decoded_spectra(mzml_filename, decode_threads, include_ms1=False, max_inflight=None):
+    """
+    Read the spectra of a mzML file without decoding their binary arrays and
+    decode the arrays in a pool of decode_threads threads (zlib releases the
+    GIL). Spectra are yielded in file order, with at most max_inflight
+    spectra (default: 64 x decode_threads) decoded ahead of the caller. The
+    arrays of MS1 spectra are only decoded with include_ms1.
+    """
+    max_inflight = max_inflight or 64 * decode_threads
+    with mzml.MzML(mzml_filename, decode_binary=False) as reader, ThreadPoolExecutor(decode_threads) as executor:
+        pending = deque()
         for spectrum in reader:
-            mz_array = spectrum['m/z array']
-            intensity_array = spectrum['intensity array']
-            scan_id = int(spectrum['id'][spectrum['id'].find('scan='):][5:])     
-            scan_lower = float(str(spectrum['scanList']['scan'][0]['scanWindowList']['scanWindow'][0]['scan window lower limit']))
-            scan_upper = float(str(spectrum['scanList']['scan'][0]['scanWindowList']['scanWindow'][0]['scan window upper limit']))
-            ret_time = float(spectrum['scanList']['scan'][0]['scan start time']) * 60
-            if spectrum['ms level'] == 1:
-                last_ms1 = {
-                    'ms1_scan_id': scan_id,
-                    'ms1_scan_begin': scan_lower,
-                    'ms1_scan_end': scan_upper,
-                    'ms1_retention_time': ret_time,
-                    'ms1_mz_array': mz_array,
-                    'ms1_intensity_array': intensity_array
-                }
-            elif spectrum['ms level'] == 2:
-                if last_ms1 is not None:
-                    if 'spectrum title' in spectrum:
-                        title = spectrum['spectrum title'].split(',')[0]
-                        scan_str = spectrum['spectrum title'].split(',')[1]
-                        scan_num = int(scan_str[scan_str.find('scan='):-1][5:])
-                    else:
-                        id_str = spectrum.get('id', '')
-                        if 'scan=' in id_str:
-                            try:
-                                scan_num = int(id_str.split('scan=')[-1])
-                            except:
-                                scan_num = None
-                        else:
+            decode = include_ms1 or spectrum.get('ms level') != 1
+            pending.append(executor.submit(decode_spectrum_arrays, spectrum, decode))
+            if len(pending) >= max_inflight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def extract_ms2_spectra(spectra, mzml_filename, include_ms1=False):
+    """
+    Yield the MS2 spectra of an iterable of pyteomics spectra, with their
+    last MS1 spectrum. The peak arrays of the MS1 spectrum are only kept
+    with include_ms1, so only the current spectra are held in memory.
+    """
+    last_ms1 = None  # last MS1 spectrum
+    for spectrum in spectra:
+        mz_array = spectrum['m/z array']
+        intensity_array = spectrum['intensity array']
+        scan_id = int(spectrum['id'][spectrum['id'].find('scan='):][5:])     
+        scan_lower = float(str(spectrum['scanList']['scan'][0]['scanWindowList']['scanWindow'][0]['scan window lower limit']))
+        scan_upper = float(str(spectrum['scanList']['scan'][0]['scanWindowList']['scanWindow'][0]['scan window upper limit']))
+        ret_time = float(spectrum['scanList']['scan'][0]['scan start time']) * 60
+        if spectrum['ms level'] == 1:
+            last_ms1 = {
+                'ms1_scan_id': scan_id,
+                'ms1_scan_begin': scan_lower,
+                'ms1_scan_end': scan_upper,
+                'ms1_retention_time': ret_time,
+                'ms1_mz_array': mz_array if include_ms1 else None,
+                'ms1_intensity_array': intensity_array if include_ms1 else None
+            }
+        elif spectrum['ms level'] == 2:
+            if last_ms1 is not None:
+                if 'spectrum title' in spectrum:
+                    title = spectrum['spectrum title'].split(',')[0]
+                    scan_str = spectrum['spectrum title'].split(',')[1]
+                    scan_num = int(scan_str[scan_str.find('scan='):-1][5:])
+                else:
+                    id_str = spectrum.get('id', '')
+                    if 'scan=' in id_str:
+                        try:
+                            scan_num = int(id_str.split('scan=')[-1])
+                        except:
                             scan_num = None
-                        title = Path(mzml_filename).stem  
-                    # ms2_scan_id = int(spectrum['spectrum title'].split(',')[1][spectrum['spectrum title'].split(',')[1].find('scan='):-1][5:])
-                    # collison_energy = float(spectrum['precursorList']['precursor'][0]['activation']['collision energy'])
-                    pepmass_mz = float(spectrum['precursorList']['precursor'][0]['selectedIonList']['selectedIon'][0]['selected ion m/z'])
-                    charge = spectrum['precursorList']['precursor'][0]['selectedIonList']['selectedIon'][0].get('charge state', None)
-                    peak_intensity = (float(spectrum['precursorList']['precursor'][0]['selectedIonList']['selectedIon'][0]['peak intensity']) 
-                                if 'peak intensity' in spectrum['precursorList']['precursor'][0]['selectedIonList']['selectedIon'][0] else None)                 
-                    collision_energy = spectrum['precursorList']['precursor'][0]['activation'].get('collision energy')
-                    total_ion_current = spectrum.get('total ion current')  
-                    result.append({
-                        'title': title,
-                        'ms2_scan_id': scan_num,
-                        'ms2_scan_begin': scan_lower,
-                        'ms2_scan_end': scan_upper,
-                        'ms2_retention_time': ret_time,
-                        'pepmass_mz': pepmass_mz,
-                        'charge': charge,
-                        'intensity': peak_intensity,
-                        'collision_energy': collision_energy,
-                        'total_ion_current': total_ion_current,
-                        'ms2_mz_array': mz_array,
-                        'ms2_intensity_array': intensity_array,
-                        'ms1_scan_id': last_ms1['ms1_scan_id'],
-                        'ms1_scan_begin': last_ms1['ms1_scan_begin'],
-                        'ms1_scan_end': last_ms1['ms1_scan_end'],
-                        'ms1_retention_time': last_ms1['ms1_retention_time'],
-                        'ms1_mz_array': last_ms1['ms1_mz_array'],
-                        'ms1_intensity_array': last_ms1['ms1_intensity_array']
-                    })
-    return result          
-
-
-def extend_mgf_write_with_ms1(spectrum2, mzml_filename, mgf_filename):
-    count_written = 0
+                    else:
+                        scan_num = None
+                    title = Path(mzml_filename).stem  
+                # ms2_scan_id = int(spectrum['spectrum title'].split(',')[1][spectrum['spectrum title'].split(',')[1].find('scan='):-1][5:])
+                # collison_energy = float(spectrum['precursorList']['precursor'][0]['activation']['collision energy'])
+                pepmass_mz = float(spectrum['precursorList']['precursor'][0]['selectedIonList']['selectedIon'][0]['selected ion m/z'])
+                charge = spectrum['precursorList']['precursor'][0]['selectedIonList']['selectedIon'][0].get('charge state', None)
+                peak_intensity = (float(spectrum['precursorList']['precursor'][0]['selectedIonList']['selectedIon'][0]['peak intensity']) 
+                            if 'peak intensity' in spectrum['precursorList']['precursor'][0]['selectedIonList']['selectedIon'][0] else None)                 
+                collision_energy = spectrum['precursorList']['precursor'][0]['activation'].get('collision energy')
+                total_ion_current = spectrum.get('total ion current')  
+                yield {
+                    'title': title,
+                    'ms2_scan_id': scan_num,
+                    'ms2_scan_begin': scan_lower,
+                    'ms2_scan_end': scan_upper,
+                    'ms2_retention_time': ret_time,
+                    'pepmass_mz': pepmass_mz,
+                    'charge': charge,
+                    'intensity': peak_intensity,
+                    'collision_energy': collision_energy,
+                    'total_ion_current': total_ion_current,
+                    'ms2_mz_array': mz_array,
+                    'ms2_intensity_array': intensity_array,
+                    'ms1_scan_id': last_ms1['ms1_scan_id'],
+                    'ms1_scan_begin': last_ms1['ms1_scan_begin'],
+                    'ms1_scan_end': last_ms1['ms1_scan_end'],
+                    'ms1_retention_time': last_ms1['ms1_retention_time'],
+                    'ms1_mz_array': last_ms1['ms1_mz_array'],
+                    'ms1_intensity_array': last_ms1['ms1_intensity_array']
+                }
+
+
+def extend_mgf_write_with_ms1(spectrum2, mzml_filename, mgf_filename, include_ms1=False):
     with open(mgf_filename, 'w') as out:
-        for spec in spectrum2:
-            out.write("BEGIN IONS\n")
-            out.write(f"MZML_FILE_NAME={os.path.basename(mzml_filename)}\n")
-            out.write(f"SCAN={spec['ms2_scan_id']}\n")
-            if "title" in spec:
-                out.write(f"TITLE={spec['title']}\n")
-            #out.write(f"MS_ONE_SCAN={spec['ms1_scan_id']}\n")
-            #out.write(f"MS_ONE_RETENTION_TIME={spec['ms1_retention_time']:.5f}\n")              
-            #out.write(f"MS_ONE_SCAN_WINDOW_LOWER_LIMIT={spec['ms1_scan_begin']}\n")
-            #out.write(f"MS_ONE_SCAN_WINDOW_UPPER_LIMIT={spec['ms1_scan_end']}\n")         
-            out.write(f"RTINSECONDS={spec['ms2_retention_time']:.5f}\n")   
-            if "pepmass_mz" in spec:
-                pepmass_mz = spec["pepmass_mz"]
-                out.write(f"PEPMASS_MZ={pepmass_mz}\n")
-            if "charge" in spec and spec["charge"] is not None:
-                out.write(f"CHARGE={spec['charge']}+\n")
-            '''
-            if spec.get('collision_energy') is not None:
-                out.write(f"COLLISION_ENERGY={spec['collision_energy']}\n")
-            if spec.get('total_ion_current') is not None:
-                out.write(f"TOTAL_ION_CURRENT={spec['total_ion_current']}\n")   
-            
-            out.write(f"MS_TWO_SCAN={spec['ms2_scan_id']}\n")
-            out.write(f"MS_TWO_SCAN_WINDOW_LOWER_LIMIT={spec['ms2_scan_begin']}\n")
-            out.write(f"MS_TWO_SCAN_WINDOW_UPPER_LIMIT={spec['ms2_scan_end']}\n")
-            '''
-            
-            # write peaks (m/z and intensity) for ms1
-            '''
-            out.write("MS_ONE_PEAKS_BEGIN\n")
-            for mz, inten in zip(spec["ms1_mz_array"], spec["ms1_intensity_array"]):
-                out.write(f"{mz:.5f} {inten:.2f}\n")
-            out.write("MS_ONE_PEAKS_END\n")
-            '''
-            
-            #out.write("MS_TWO_PEAKS_BEGIN\n")
-            # write peaks (m/z and intensity) for ms2
-            for mz, inten in zip(spec["ms2_mz_array"], spec["ms2_intensity_array"]):
-                out.write(f"{mz:.5f} {inten:.2f}\n")
-            #out.write("MS_TWO_PEAKS_END\n")
-    
-            out.write("END IONS\n\n")
-            count_written += 1 
+        return write_mgf_spectra(out, spectrum2, mzml_filename, include_ms1)
+
+
+def write_mgf_spectra(out, spectrum2, mzml_filename, include_ms1=False):
+    # with include_ms1, the scan and the peaks of the MS1 spectrum are
+    # written before the MS2 peaks
+    count_written = 0
+    for spec in spectrum2:
+        # the lines of a spectrum are written at once
+        block = []
+        block.append("BEGIN IONS\n")
+        block.append(f"MZML_FILE_NAME={os.path.basename(mzml_filename)}\n")
+        block.append(f"SCAN={spec['ms2_scan_id']}\n")
+        if "title" in spec:
+            block.append(f"TITLE={spec['title']}\n")
+        if include_ms1:
+            block.append(f"MS_ONE_SCAN={spec['ms1_scan_id']}\n")
+            block.append(f"MS_ONE_RETENTION_TIME={spec['ms1_retention_time']:.5f}\n")              
+        #block.append(f"MS_ONE_SCAN_WINDOW_LOWER_LIMIT={spec['ms1_scan_begin']}\n")
+        #block.append(f"MS_ONE_SCAN_WINDOW_UPPER_LIMIT={spec['ms1_scan_end']}\n")         
+        block.append(f"RTINSECONDS={spec['ms2_retention_time']:.5f}\n")   
+        if "pepmass_mz" in spec:
+            pepmass_mz = spec["pepmass_mz"]
+            block.append(f"PEPMASS_MZ={pepmass_mz}\n")
+        if "charge" in spec and spec["charge"] is not None:
+            block.append(f"CHARGE={spec['charge']}+\n")
+        '''
+        if spec.get('collision_energy') is not None:
+            block.append(f"COLLISION_ENERGY={spec['collision_energy']}\n")
+        if spec.get('total_ion_current') is not None:
+            block.append(f"TOTAL_ION_CURRENT={spec['total_ion_current']}\n")   
+        
+        block.append(f"MS_TWO_SCAN={spec['ms2_scan_id']}\n")
+        block.append(f"MS_TWO_SCAN_WINDOW_LOWER_LIMIT={spec['ms2_scan_begin']}\n")
+        block.append(f"MS_TWO_SCAN_WINDOW_UPPER_LIMIT={spec['ms2_scan_end']}\n")
+        '''
+        
+        # write peaks (m/z and intensity) for ms1
+        if include_ms1:
+            block.append("MS_ONE_PEAKS_BEGIN\n")
+            block.append(peak_format.format_mz_intensity_block(spec["ms1_mz_array"], spec["ms1_intensity_array"]))
+            block.append("MS_ONE_PEAKS_END\n")
+            block.append("MS_TWO_PEAKS_BEGIN\n")
+        
+        # write peaks (m/z and intensity) for ms2
+        block.append(peak_format.format_mz_intensity_block(spec["ms2_mz_array"], spec["ms2_intensity_array"]))
+        if include_ms1:
+            block.append("MS_TWO_PEAKS_END\n")
+
+        block.append("END IONS\n\n")
+        out.write("".join(block))
+        count_written += 1 
+    return count_written
+
+
+# ---------- PARALLEL CONVERSION OF INDEXED MZML FILES ----------
+def read_spectrum_offsets(mzml_filename):
+    """
+    Read the spectrum offsets of the indexList of an indexed mzML file.
+    Returns a list of (spectrum id, byte offset) in file order, or None if
+    the file has no index.
+    """
+    with open(mzml_filename, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(size - 4096, 0))
+        match = re.search(rb"<indexListOffset>\s*(\d+)\s*</indexListOffset>", f.read())
+        if match is None:
+            return None
+        index_offset = int(match.group(1))
+        if index_offset >= size:
+            return None
+        f.seek(index_offset)
+        index_list = f.read(size - index_offset)
+    match = re.search(rb'<index\s+name="spectrum"\s*>(.*?)</index>', index_list, re.DOTALL)
+    if match is None:
+        return None
+    offsets = [(unescape(spectrum_id.decode("utf-8"), {"&quot;": '"', "&apos;": "'"}), int(offset))
+               for spectrum_id, offset in re.findall(rb'<offset\s+idRef="([^"]*)"[^>]*>\s*(\d+)\s*</offset>', match.group(1))]
+    if not offsets:
+        return None
+    offsets.sort(key=lambda item: item[1])
+    return offsets
+
+
+def read_ms_level(f, offset):
+    # ms level of the spectrum at offset, from the cvParams of its header
+    f.seek(offset)
+    head = f.read(8192)
+    end = head.find(b"</spectrum>")
+    if end >= 0:
+        head = head[:end]
+    for param in re.findall(rb"<cvParam[^>]*>", head):
+        if b'"MS:1000511"' in param or b'name="ms level"' in param:
+            match = re.search(rb'value="(\d+)"', param)
+            if match is not None:
+                return int(match.group(1))
+    return None
+
+
+def split_spectrum_ranges(mzml_filename, offsets, range_size=2000):
+    """
+    Split the spectra of offsets into contiguous ranges of about range_size
+    spectra. Each range but the first starts at a MS1 spectrum, so the MS2
+    spectra of a range are matched to the same MS1 spectrum as in a serial run.
+    Returns a list of lists of spectrum ids.
+    """
+    boundaries = [0]
+    with open(mzml_filename, "rb") as f:
+        k = range_size
+        while k < len(offsets):
+            while k < len(offsets) and read_ms_level(f, offsets[k][1]) != 1:
+                k += 1
+            if k >= len(offsets):
+                break
+            boundaries.append(k)
+            k += range_size
+    boundaries.append(len(offsets))
+    ids = [spectrum_id for spectrum_id, _ in offsets]
+    return [ids[begin:end] for begin, end in zip(boundaries[:-1], boundaries[1:])]
+
+
+# reader of a pool worker, opened by init_convert_worker
+_WORKER_STATE = {}
+
+
+def init_convert_worker(mzml_filename, include_ms1=False):
+    _WORKER_STATE["mzml_filename"] = mzml_filename
+    _WORKER_STATE["include_ms1"] = include_ms1
+    _WORKER_STATE["reader"] = mzml.PreIndexedMzML(mzml_filename)
+
+
+def convert_spectrum_range(spectrum_ids):
+    """Worker function: return the MGF text and the number of MS2 spectra of a range of spectra."""
+    mzml_filename = _WORKER_STATE["mzml_filename"]
+    include_ms1 = _WORKER_STATE["include_ms1"]
+    reader = _WORKER_STATE["reader"]
+    spectra = (reader.get_by_id(spectrum_id) for spectrum_id in spectrum_ids)
+    out = io.StringIO()
+    count = write_mgf_spectra(out, extract_ms2_spectra(spectra, mzml_filename, include_ms1), mzml_filename, include_ms1)
+    return out.getvalue(), count
+
+
+def convert_mzml_to_mgf(mzml_filename, mgf_filename, num_workers=1, range_size=2000, include_ms1=False, decode_threads=0):
+    """
+    Convert a mzML file to a MGF file. Spectra are written while they are
+    read (see extract_ms2_spectra). With num_workers > 1 and an indexed
+    mzML file, ranges of spectra (split_spectrum_ranges) are converted in
+    worker processes and their MGF blocks are written in file order. Other
+    files are converted serially, with the binary arrays decoded by
+    decode_threads threads if decode_threads > 0 (iter_decoded_spectra).
+    """
+    offsets = read_spectrum_offsets(mzml_filename) if num_workers > 1 else None
+    if offsets is None:
+        if num_workers > 1:
+            print(f"{mzml_filename} has no spectrum index, converting serially")
+        if decode_threads > 0:
+            spectra = iter_decoded_spectra(mzml_filename, decode_threads, include_ms1)
+            mzml_spectrum = extract_ms2_spectra(spectra, mzml_filename, include_ms1)
+        else:
+            mzml_spectrum = mzML_ms_extract_with_ms1(mzml_filename, include_ms1)
+        return extend_mgf_write_with_ms1(mzml_spectrum, mzml_filename, mgf_filename, include_ms1)
+    spectrum_ranges = split_spectrum_ranges(mzml_filename, offsets, range_size)
+    print(f"Converting {len(offsets)} spectra in {len(spectrum_ranges)} ranges with {num_workers} workers")
+    count_written = 0
+    # at most 2 x num_workers ranges are converted ahead of the writer
+    max_inflight = 2 * num_workers
+    with Pool(num_workers, initializer=init_convert_worker, initargs=(mzml_filename, include_ms1)) as pool, \
+            open(mgf_filename, 'w') as out:
+        pending = deque()
+        ranges = iter(spectrum_ranges)
+        while True:
+            while len(pending) < max_inflight:
+                spectrum_ids = next(ranges, None)
+                if spectrum_ids is None:
+                    break
+                pending.append(pool.apply_async(convert_spectrum_range, (spectrum_ids,)))
+            if not pending:
+                break
+            text, count = pending.popleft().get()
+            out.write(text)
+            count_written += count
+    return count_written
 
 
 if __name__ == "__main__":
-    if len(sys.argv) !=3:
-        print("Usage: python script.py <input_mzml_filename> <output_mgf_filename>")
-        sys.exit()
-    else:
-        mzml_filename = sys.argv[1] # input the mzML files folder 
-        mgf_filename = sys.argv[2]
-        print(f"converting: {mzml_filename}")
-        mzml_spectrum = mzML_ms_extract_with_ms1(mzml_filename)  
-        extend_mgf_write_with_ms1(mzml_spectrum, mzml_filename, mgf_filename)
+    parser = argparse.ArgumentParser(description="Convert a mzML file to a MGF file of its MS2 spectra")
+    parser.add_argument("mzml_filename", help="Input mzML filename")
+    parser.add_argument("mgf_filename", help="Output MGF filename")
+    parser.add_argument(
+        "--num_workers", "-n", type=int, default=1,
+        help="Number of worker processes for indexed mzML files (default: 1)")
+    parser.add_argument(
+        "--range_size", type=int, default=2000,
+        help="Number of spectra in a range converted by a worker (default: 2000)")
+    parser.add_argument(
+        "--ms1", action="store_true",
+        help="Write the scan and the peaks of the MS1 spectrum of each MS2 spectrum")
+    parser.add_argument(
+        "--decode_threads", type=int, default=0,
+        help="Number of threads decoding the binary arrays in serial conversion (default: 0, decode while parsing)")
+    args = parser.parse_args()
+    print(f"converting: {args.mzml_filename}")
+    convert_mzml_to_mgf(args.mzml_filename, args.mgf_filename, args.num_workers, args.range_size, args.ms1,
+                        args.decode_threads)
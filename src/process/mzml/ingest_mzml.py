@@ -0,0 +1,54 @@
+"""
+this version writes the spectral information TSV file and the mgf file of a
+mzML file in one pass
+
+"""
+from pyteomics import mzml
+import argparse
+import itertools
+import extract_mzml_info
+import convert_mzml_to_mgf
+
+
+def ingest_mzml(dataset_id, mzml_filename, tsv_filename, mgf_filename, include_ms1=False):
+    """
+    Read the spectra of a mzML file once and write the outputs of
+    extract_mzml_info.py (tsv_filename) and convert_mzml_to_mgf.py
+    (mgf_filename). Both extractors read the same spectra through
+    itertools.tee and yield one item for each MS2 spectrum, so they are
+    advanced in step and only the spectra between two MS2 spectra are
+    buffered.
+    """
+    print(f"Extracting metadata and peaks from: {mzml_filename} ({dataset_id})")
+    result = []
+    with mzml.MzML(mzml_filename) as reader:
+        instrument_name = extract_mzml_info.get_instrument_name_safe(reader)
+        print(f"instrument: {instrument_name}")
+        reader.reset()
+        info_spectra, mgf_spectra = itertools.tee(reader, 2)
+        records = extract_mzml_info.iter_ms2_records(dataset_id, mzml_filename, instrument_name, info_spectra)
+        spectrum2 = convert_mzml_to_mgf.extract_ms2_spectra(mgf_spectra, mzml_filename, include_ms1)
+
+        def iter_mgf_spectra():
+            for record, spec in zip(records, spectrum2):
+                result.append(record)
+                yield spec
+
+        count_written = convert_mzml_to_mgf.extend_mgf_write_with_ms1(iter_mgf_spectra(), mzml_filename, mgf_filename,
+                                                                     include_ms1)
+    print(f"Wrote {count_written} MS2 spectra to {mgf_filename}")
+    extract_mzml_info.write_info_tsv(result, mzml_filename, tsv_filename)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Extract spectral information and MS2 peaks from a mzML file in one pass")
+    parser.add_argument("dataset_id", help="MS dataset ID")
+    parser.add_argument("mzml_filename", help="Input mzML filename")
+    parser.add_argument("tsv_filename", help="Output TSV filename for the spectral information")
+    parser.add_argument("mgf_filename", help="Output MGF filename")
+    parser.add_argument(
+        "--ms1", action="store_true",
+        help="Write the scan and the peaks of the MS1 spectrum of each MS2 spectrum in the MGF file")
+    args = parser.parse_args()
+    ingest_mzml(args.dataset_id, args.mzml_filename, args.tsv_filename, args.mgf_filename, args.ms1)